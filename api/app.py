@@ -2,18 +2,70 @@ from fastapi import FastAPI, status, HTTPException, Depends
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from fastapi.openapi.utils import get_openapi
+import asyncio
+import contextlib
 import logging
-from sqlalchemy.orm import Session
+from sqlalchemy import select, text
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from api.routers import Auth, User, Message, Group, DirectMessage, Friends, Websocket
-from api.db.database import Base, engine
+from api.db.database import Base, engine, SessionLocal, async_engine
 from api.config.settings import settings
+from api.middleware.security import SecurityMiddleware
 from api.utils.crud import get_db
+from api.utils.conversations import backfill_dm_conversations
+from api.utils.read_state import backfill_read_states, unread_counter
+from api.utils.password_hashing import password_hasher
+from api.utils.message_history import message_history
+from api.utils.presence import presence_writer
+from api.utils.rate_limit import rate_limiter
+from api.utils.read_receipts import read_receipts
+from api.utils.responses import FastJSONResponse
+from api.utils.user_cache import user_cache
+from api.utils.websocket_manager import connection_manager
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 Base.metadata.create_all(bind=engine)
+# create_all skips tables that already exist, so add indexes introduced since
+for table in Base.metadata.sorted_tables:
+    for index in table.indexes:
+        index.create(bind=engine, checkfirst=True)
+# ...and drop the ones no query uses any more
+with engine.begin() as connection:
+    connection.execute(text("DROP INDEX IF EXISTS ix_direct_messages_receiver_sender_time"))
+with SessionLocal() as session:
+    backfill_dm_conversations(session)
+    backfill_read_states(session)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    if settings.bcrypt_target_ms > 0:
+        await password_hasher.calibrate(settings.bcrypt_target_ms, settings.bcrypt_min_rounds, settings.bcrypt_max_rounds)
+    await connection_manager.start()
+    flush_tasks = [
+        asyncio.create_task(unread_counter.run(settings.unread_flush_interval)),
+        asyncio.create_task(presence_writer.run(settings.presence_flush_interval)),
+        asyncio.create_task(read_receipts.run(settings.read_receipt_flush_interval)),
+        asyncio.create_task(rate_limiter.run(settings.rate_limit_sync_interval)),
+    ]
+    yield
+    for task in flush_tasks:
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+    await unread_counter.flush()
+    await read_receipts.flush()
+    # Users still connected to this worker are going away with it
+    for user_id in connection_manager.online_users - connection_manager.remote_online.keys():
+        presence_writer.record_offline(user_id)
+    await presence_writer.flush()
+    await connection_manager.close()
+    password_hasher.shutdown()
+    await async_engine.dispose()
+
 
 app = FastAPI(
     title=settings.api_title,
@@ -22,8 +74,13 @@ app = FastAPI(
     docs_url="/docs" if settings.debug else None,
     redoc_url="/redoc" if settings.debug else None,
     openapi_url="/openapi.json" if settings.debug else None,
+    lifespan=lifespan,
+    # Routes with a response_model are serialized by pydantic, skipping jsonable_encoder
+    default_response_class=FastJSONResponse,
 )
 
+# Added first so CORS wraps it and 429 responses still carry CORS headers
+app.add_middleware(SecurityMiddleware, limiter=rate_limiter, trusted_proxies=settings.trusted_proxy_list)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=settings.cors_origins,
@@ -54,17 +111,29 @@ async def health_check():
     return {"status": "healthy", "version": settings.api_version}
 
 @app.get("/debug/users", tags=["Debug"])
-async def debug_users(db: Session = Depends(get_db)):
+async def debug_users(db: AsyncSession = Depends(get_db)):
     if not settings.debug:
         raise HTTPException(status_code=404, detail="Not found")
     
     from api.models.models import User
-    users = db.query(User).all()
+    users = (await db.scalars(select(User))).all()
     return {
         "count": len(users),
         "users": [{"id": u.id, "username": u.username, "email": u.email} for u in users]
     }
 
+@app.get("/debug/user-cache", tags=["Debug"])
+async def debug_user_cache():
+    if not settings.debug:
+        raise HTTPException(status_code=404, detail="Not found")
+    return user_cache.stats()
+
+@app.get("/debug/history-cache", tags=["Debug"])
+async def debug_history_cache():
+    if not settings.debug:
+        raise HTTPException(status_code=404, detail="Not found")
+    return message_history.stats()
+
 def custom_openapi():
     if app.openapi_schema:
         return app.openapi_schema
@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Optional
 from pydantic_settings import BaseSettings
 from pydantic import field_validator
 
@@ -9,8 +9,26 @@ class Settings(BaseSettings):
     jwt_algorithm: str = "HS256"
     jwt_access_token_expire_minutes: int = 30
     jwt_refresh_token_expire_days: int = 7
+    # Verified tokens remembered until they expire, skipping the HMAC check
+    token_cache_size: int = 10000
     
+    # 0 to 31, distinct per process; required when broker_url is set, 0 otherwise
+    snowflake_worker_id: Optional[int] = None
+
+    # Users resolved by get_current_user without a query, for up to the TTL
+    user_cache_size: int = 10000
+    user_cache_ttl: float = 60.0
+
+    # Used as is when bcrypt_target_ms is 0; otherwise startup benchmarks the
+    # cost that fits the budget, within the min/max bounds
     bcrypt_rounds: int = 12
+    bcrypt_target_ms: float = 250.0
+    bcrypt_min_rounds: int = 10
+    bcrypt_max_rounds: int = 15
+    # Threads hashing passwords (defaults to min(4, CPUs)) and requests allowed
+    # to wait for one before login/register answer 503
+    bcrypt_workers: Optional[int] = None
+    bcrypt_queue_limit: int = 64
     password_min_length: int = 8
     password_max_length: int = 128
     
@@ -27,15 +45,69 @@ class Settings(BaseSettings):
         "http://127.0.0.1:5173"
     ]
     
+    message_page_size: int = 25
+    dm_page_size: int = 50
+    group_page_size: int = 50
+    max_page_size: int = 100
+    # Newest messages kept in memory per active group to serve first pages,
+    # and the total size and number of buffers before idle groups are dropped
+    history_cache_size: int = 50
+    history_cache_bytes: int = 32 * 1024 * 1024
+    history_cache_groups: int = 10000
+    # Messages accepted by one call of the batch send endpoint
+    message_batch_size: int = 100
+    # Rows read per query while streaming a history export
+    export_batch_size: int = 1000
+    
+    # Requests per client IP over a sliding window; an IP refused as many times
+    # again within one window is blocked for rate_limit_block_seconds
+    rate_limit_requests: int = 600
+    rate_limit_window: float = 60.0
+    rate_limit_block_seconds: float = 900.0
+    # Clients tracked at once, least recently seen dropped first
+    rate_limit_max_clients: int = 100000
+    # Seconds between exchanges of request counts between workers sharing a broker
+    rate_limit_sync_interval: float = 1.0
+    # Comma-separated reverse proxies (IPs or CIDR ranges) whose X-Forwarded-For
+    # and X-Real-IP headers are believed; requests from anywhere else are limited
+    # by peer address. A plain string, as pydantic-settings JSON-decodes list
+    # fields read from the environment
+    trusted_proxies: str = ""
+    
+    # Per-socket send deadline during broadcast fan-out
+    ws_send_timeout: float = 5.0
+
+    # Empty keeps rooms in this process; tcp://host:port or unix:///path shares
+    # them between workers through `python -m api.utils.broker`
+    broker_url: str = ""
+
+    # Window over which presence changes are coalesced into one diff frame
+    presence_batch_interval: float = 1.0
+    # Seconds between batched writes of users' online state and last_seen
+    presence_flush_interval: float = 5.0
+
+    # Typing entries expire without a stop frame; rooms get one frame per interval
+    typing_timeout: float = 6.0
+    typing_interval: float = 0.5
+    
+    # Seconds between batched writes of buffered group unread counters
+    unread_flush_interval: float = 2.0
+    # Seconds over which WebSocket read receipts are collapsed before being stored
+    read_receipt_flush_interval: float = 1.0
+    
     debug: bool = True
 
     @field_validator('cors_origins', mode='before')
     @classmethod
     def parse_cors_origins(cls, v):
         if isinstance(v, str):
-            return [origin.strip() for origin in v.split(',')]
+            return [origin.strip() for origin in v.split(',') if origin.strip()]
         return v
 
+    @property
+    def trusted_proxy_list(self) -> List[str]:
+        return [proxy.strip() for proxy in self.trusted_proxies.split(',') if proxy.strip()]
+
     class Config:
         env_file = ".env"
         case_sensitive = False
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, JSON, Boolean, BigInteger, ForeignKey, UniqueConstraint
+from sqlalchemy import Column, Integer, String, DateTime, JSON, Boolean, BigInteger, ForeignKey, UniqueConstraint, Index
 from sqlalchemy.orm import relationship
 from api.db.database import Base
 from datetime import datetime
@@ -43,6 +43,11 @@ class Friend(Base):
     friend = relationship('User', foreign_keys=[friend_id])
     requester = relationship('User', foreign_keys=[requester_id])
 
+    __table_args__ = (
+        Index('ix_friends_user_status', 'user_id', 'status'),
+        Index('ix_friends_friend_status', 'friend_id', 'status'),
+    )
+
 
 class Group(Base):
     __tablename__ = "groups"
@@ -70,8 +75,10 @@ class GroupMember(Base):
     member = relationship('User', back_populates='groups')
     group = relationship('Group', back_populates='members')
     
+    # unique_member_group also serves lookups by member_id
     __table_args__ = (
         UniqueConstraint('member_id', 'group_id', name='unique_member_group'),
+        Index('ix_groupmembers_group', 'group_id'),
     )
 
 
@@ -92,6 +99,11 @@ class Message(Base):
     group = relationship("Group", back_populates="messages")
     reply_to = relationship("Message", remote_side=[id], backref="replies")
 
+    __table_args__ = (
+        Index('ix_messages_group_deleted_time', 'group_id', 'is_deleted', 'timeSent', 'id'),
+        Index('ix_messages_sender_time', 'sender_id', 'timeSent'),
+    )
+
 
 class DirectMessage(Base):
     __tablename__ = "direct_messages"
@@ -110,17 +122,44 @@ class DirectMessage(Base):
     receiver = relationship("User", foreign_keys=[receiver_id], back_populates="received_direct_messages")
     reply_to = relationship("DirectMessage", remote_side=[id], backref="replies")
 
+    __table_args__ = (
+        Index('ix_direct_messages_sender_receiver_time', 'sender_id', 'receiver_id', 'timeSent', 'id'),
+    )
 
-class LastSeen(Base):
-    __tablename__ = 'lastseen'
-    chat_id = Column(BigInteger, primary_key=True)
-    member_id = Column(BigInteger, ForeignKey("users.id"), nullable=False)
-    chat_type = Column(String, nullable=False)  # 'direct' or 'group'
-    last_seen_message_id = Column(BigInteger, nullable=True)  
+
+class DMConversation(Base):
+    # One row per participant, so listing a user's conversations is a single index range
+    __tablename__ = "dm_conversations"
+    id = Column(BigInteger, primary_key=True)
+    user_id = Column(BigInteger, ForeignKey("users.id"), nullable=False)
+    partner_id = Column(BigInteger, ForeignKey("users.id"), nullable=False)
+    last_message_id = Column(BigInteger, ForeignKey("direct_messages.id"), nullable=True)
+    last_message_at = Column(DateTime, nullable=True)
+    last_read_message_id = Column(BigInteger, nullable=True)
+    unread_count = Column(Integer, default=0)
+
+    user = relationship("User", foreign_keys=[user_id])
+    partner = relationship("User", foreign_keys=[partner_id])
+    last_message = relationship("DirectMessage", foreign_keys=[last_message_id])
+
+    __table_args__ = (
+        UniqueConstraint('user_id', 'partner_id', name='unique_dm_conversation'),
+        Index('ix_dm_conversations_user_last', 'user_id', 'last_message_at', 'id'),
+    )
+
+
+class ReadState(Base):
+    # Per-(member, group) read position; DM read state lives on DMConversation
+    __tablename__ = "read_states"
+    member_id = Column(BigInteger, ForeignKey("users.id"), primary_key=True)
+    group_id = Column(BigInteger, ForeignKey("groups.id"), primary_key=True)
+    last_read_message_id = Column(BigInteger, nullable=True)
     unread_count = Column(Integer, default=0)
-    lastseen = Column(DateTime, default=datetime.now)
+    last_read_at = Column(DateTime, default=datetime.now)
 
     member = relationship("User")
+    group = relationship("Group")
 
-    last_seen_direct_message = relationship("DirectMessage", foreign_keys=[last_seen_message_id], primaryjoin="and_(LastSeen.last_seen_message_id==DirectMessage.id, LastSeen.chat_type=='direct')", viewonly=True)
-    last_seen_group_message = relationship("Message", foreign_keys=[last_seen_message_id], primaryjoin="and_(LastSeen.last_seen_message_id==Message.id, LastSeen.chat_type=='group')", viewonly=True)
+    __table_args__ = (
+        Index('ix_read_states_group', 'group_id'),
+    )
@@ -1,10 +1,9 @@
 from sqlite3 import IntegrityError
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordRequestForm, OAuth2PasswordBearer
-from sqlalchemy import or_
-from sqlalchemy.orm import Session
+from sqlalchemy import or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import datetime, timedelta
-import bcrypt
 import re
 import logging
 from typing import Optional
@@ -21,6 +20,8 @@ from api.utils.authentication import (
     verify_refresh_token
 )
 from api.utils.ext import generate_unique_id
+from api.utils.password_hashing import password_hasher
+from api.utils.user_cache import invalidate_user
 from api.config.settings import settings
 
 router = APIRouter(
@@ -52,25 +53,18 @@ def validate_password(password: str) -> bool:
     
     return True
 
-def hash_password(password: str) -> str:
-    salt = bcrypt.gensalt(rounds=settings.bcrypt_rounds)
-    return bcrypt.hashpw(password.encode('utf-8'), salt).decode('utf-8')
-
-def verify_password(password: str, hashed_password: str) -> bool:
-    return bcrypt.checkpw(password.encode('utf-8'), hashed_password.encode('utf-8'))
-
 
 @router.post("/register", response_model=TokenResponse, status_code=status.HTTP_201_CREATED)
-async def register(userDetails: UserFrom, db: Session = Depends(get_db)):
+async def register(userDetails: UserFrom, db: AsyncSession = Depends(get_db)):
     if not validate_password(userDetails.password):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Password must be at least 8 characters long and contain uppercase, lowercase, digit, and special character"
         )
     
-    existing_user = db.query(User).filter(
+    existing_user = await db.scalar(select(User).where(
         or_(User.email == userDetails.email, User.username == userDetails.username)
-    ).first()
+    ))
     
     if existing_user:
         if existing_user.email == userDetails.email:
@@ -84,22 +78,22 @@ async def register(userDetails: UserFrom, db: Session = Depends(get_db)):
                 detail="Username already taken"
             )
 
-    hashed_password = hash_password(userDetails.password)
+    hashed_password = await password_hasher.hash(userDetails.password)
     
     user = User(
         email=userDetails.email,
         hashed_password=hashed_password,
         nickname=userDetails.nickname,
         username=userDetails.username,
-        id=generate_unique_id(db)
+        id=generate_unique_id()
     )
 
     try:
         db.add(user)
-        db.commit()
-        db.refresh(user)
+        await db.commit()
+        await db.refresh(user)
     except IntegrityError:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="User registration failed"
@@ -128,11 +122,11 @@ async def register(userDetails: UserFrom, db: Session = Depends(get_db)):
 @router.post("/login", response_model=TokenResponse)
 async def login(
     form_data: OAuth2PasswordRequestForm = Depends(),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    user = db.query(User).filter(
+    user = await db.scalar(select(User).where(
         or_(User.email == form_data.username, User.username == form_data.username)
-    ).first()
+    ))
     
     if not user:
         raise HTTPException(
@@ -141,7 +135,7 @@ async def login(
             headers={"WWW-Authenticate": "Bearer"},
         )
     
-    if not verify_password(form_data.password, user.hashed_password):
+    if not await password_hasher.verify(form_data.password, user.hashed_password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect password",
@@ -154,6 +148,9 @@ async def login(
             detail="Account has been deactivated"
         )
     
+    if password_hasher.needs_rehash(user.hashed_password):
+        password_hasher.rehash_later(user.id, form_data.password, user.hashed_password)
+    
     access_token = create_access_token(data={'user_id': user.id})
     refresh_token = create_refresh_token(data={'user_id': user.id})
     
@@ -177,7 +174,7 @@ async def login(
 @router.post("/refresh", response_model=TokenResponse)
 async def refresh_token(
     refresh_data: RefreshTokenRequest,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     payload = verify_refresh_token(refresh_data.refresh_token)
     if not payload:
@@ -193,7 +190,7 @@ async def refresh_token(
             detail="Invalid refresh token"
         )
     
-    user = db.query(User).filter(User.id == user_id).first()
+    user = await db.scalar(select(User).where(User.id == user_id))
     if not user or user.is_deleted:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -240,9 +237,9 @@ async def logout(current_user: User = Depends(get_current_user)):
 async def change_password(
     password_data: PasswordChangeRequest,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    if not verify_password(password_data.old_password, current_user.hashed_password):
+    if not await password_hasher.verify(password_data.old_password, current_user.hashed_password):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Incorrect current password"
@@ -261,11 +258,12 @@ async def change_password(
         )
     
     try:
-        current_user.hashed_password = hash_password(password_data.new_password)
-        db.commit()
+        current_user.hashed_password = await password_hasher.hash(password_data.new_password)
+        await db.commit()
+        await invalidate_user(current_user.id)
         logger.info(f"Password changed for user {current_user.id}")
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         logger.error(f"Failed to change password for user {current_user.id}: {e}")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -2,34 +2,42 @@ from fastapi import (
     Depends,
     APIRouter,
     HTTPException,
+    Query,
     status,
     WebSocketDisconnect,
     WebSocket,
 )
-from sqlalchemy.orm import Session
-from sqlalchemy import desc, or_, and_
-from api.utils.crud import get_db
-from api.models.models import User, DirectMessage, Friend
+from sqlalchemy import delete, desc, or_, and_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+from api.utils.crud import get_db, keyset_paginate, keyset_page, keyset_union
+from api.models.models import User, DirectMessage, DMConversation, Friend
 from api.utils.authentication import get_current_user, verify_token_access
-from api.utils.ext import generate_unique_id, broadcast
+from api.utils.ext import generate_unique_id
+from api.utils.export import export_dm, export_response
+from api.utils.conversations import conversation_pair, message_directions, record_dm_sent, record_dm_deleted, mark_dm_read
 from api.utils.websocket_manager import connection_manager
-from api.schema.schema import MessageForm, MessageEditForm, MessageDeleteResponse
-from typing import Dict, List
+from api.schema.schema import MessageForm, MessageEditForm, MessageDeleteResponse, DirectMessagePage
+from typing import Dict, List, Optional
 import json
 from datetime import datetime
+from api.config.settings import settings
 
 router = APIRouter(prefix="/dm", tags=['Direct Messages'])
-connected_dm_clients: Dict[str, List[WebSocket]] = {}
+# Shared with the manager so broadcasts reach these sockets on every worker
+connected_dm_clients: Dict[str, List[WebSocket]] = connection_manager.dm_chat_connections
 
 
 @router.websocket("/chat/{user_id}")
 async def dm_websocket(
     user_id: int,
     websocket: WebSocket,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
     # Verify user exists
-    user = db.query(User).filter(User.id == user_id).first()
+    user = await db.scalar(select(User).where(User.id == user_id))
+    # Hand the pooled connection back; the socket may stay open for hours
+    await db.close()
     if not user:
         await websocket.close(code=4004)
         return
@@ -58,52 +66,76 @@ async def dm_websocket(
         while True:
             data = await websocket.receive_json()
             print(f"DM data received: {data}")
-            await broadcast_dm(chat_room_id, data, connected_dm_clients)
+            await connection_manager.broadcast_to_dm_chat(chat_room_id, data)
     except WebSocketDisconnect:
         if chat_room_id in connected_dm_clients and websocket in connected_dm_clients[chat_room_id]:
             connected_dm_clients[chat_room_id].remove(websocket)
 
 
-async def broadcast_dm(chat_room_id: str, message: dict, clients: Dict[str, List[WebSocket]]):
-    if chat_room_id in clients:
-        disconnected = []
-        for websocket in clients[chat_room_id]:
-            try:
-                await websocket.send_json(message)
-            except:
-                disconnected.append(websocket)
-        
-        for ws in disconnected:
-            clients[chat_room_id].remove(ws)
-
-
 @router.post("/{receiver_id}/send")
 async def send_direct_message(
     receiver_id: int,
     content: MessageForm,
+    reply_to_id: int = None,
     user=Depends(get_current_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
-    receiver = db.query(User).filter(User.id == receiver_id).first()
+    receiver = await db.scalar(select(User).where(User.id == receiver_id))
     if not receiver:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, 
             detail="User not found"
         )
     
-    message_id = generate_unique_id(db)
+    reply_to = None
+    if reply_to_id:
+        reply_to = (await db.execute(
+            select(DirectMessage, User).join(
+                User, DirectMessage.sender_id == User.id
+            ).where(
+                DirectMessage.id == reply_to_id,
+                or_(
+                    and_(DirectMessage.sender_id == user.id, DirectMessage.receiver_id == receiver_id),
+                    and_(DirectMessage.sender_id == receiver_id, DirectMessage.receiver_id == user.id)
+                ),
+                DirectMessage.is_deleted == False
+            )
+        )).first()
+        if not reply_to:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Reply target message not found"
+            )
+    
+    message_id = generate_unique_id()
     content_data = {"content": content.content}
     
     dm = DirectMessage(
         id=message_id,
         content=content_data,
         sender_id=user.id,
-        receiver_id=receiver_id
+        receiver_id=receiver_id,
+        reply_to_id=reply_to_id
     )
     
     db.add(dm)
-    db.commit()
-    db.refresh(dm)
+    await db.flush()
+    await record_dm_sent(db, dm)
+    await db.commit()
+    await db.refresh(dm)
+    
+    reply_info = None
+    if reply_to:
+        reply_message, reply_user = reply_to
+        reply_info = {
+            "id": reply_message.id,
+            "content": reply_message.content,
+            "sender": {
+                "id": reply_user.id,
+                "username": reply_user.username,
+                "nickname": reply_user.nickname,
+            }
+        }
     
     # Prepare message for broadcast
     message_data = {
@@ -113,6 +145,7 @@ async def send_direct_message(
         "timeSent": dm.timeSent.isoformat(),
         "is_edited": dm.is_edited,
         "edited_at": None,
+        "reply_to": reply_info,
         "sender": {
             "id": user.id,
             "username": user.username,
@@ -129,43 +162,66 @@ async def send_direct_message(
     
     # Broadcast to DM room
     chat_room_id = f"{min(user.id, receiver_id)}_{max(user.id, receiver_id)}"
-    await broadcast_dm(chat_room_id, message_data, connected_dm_clients)
-    await connection_manager.broadcast_to_dm(chat_room_id, message_data)
+    await connection_manager.broadcast_dm_event(chat_room_id, message_data)
     
     return {"data": message_data}
 
 
-@router.get("/{user_id}/messages")
+@router.get("/{user_id}/messages", response_model=DirectMessagePage)
 async def get_direct_messages(
     user_id: int,
+    before: Optional[int] = None,
+    after: Optional[int] = None,
+    limit: int = Query(settings.dm_page_size, ge=1, le=settings.max_page_size),
     user=Depends(get_current_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
-    other_user = db.query(User).filter(User.id == user_id).first()
+    other_user = await db.scalar(select(User).where(User.id == user_id))
     if not other_user:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="User not found"
         )
     
-    messages = db.query(DirectMessage, User).join(
-        User, DirectMessage.sender_id == User.id
-    ).filter(
-        or_(
-            and_(DirectMessage.sender_id == user.id, DirectMessage.receiver_id == user_id),
-            and_(DirectMessage.sender_id == user_id, DirectMessage.receiver_id == user.id)
+    # Reply targets and their senders come back in the same row as the message
+    ReplyMessage = aliased(DirectMessage)
+    ReplyUser = aliased(User)
+    # One index seek per direction of the conversation, merged in order
+    rows = (await db.execute(keyset_union(
+        select(DirectMessage, User, ReplyMessage, ReplyUser).join(
+            User, DirectMessage.sender_id == User.id
+        ).outerjoin(
+            ReplyMessage, DirectMessage.reply_to_id == ReplyMessage.id
+        ).outerjoin(
+            ReplyUser, ReplyMessage.sender_id == ReplyUser.id
         ),
-        DirectMessage.is_deleted == False
-    ).order_by(desc(DirectMessage.timeSent)).limit(50).all()
+        DirectMessage,
+        [(*direction, DirectMessage.is_deleted == False) for direction in message_directions(user.id, user_id)],
+        before=before, after=after, limit=limit
+    ))).all()
+    messages, next_cursor = keyset_page(rows, limit, after=after)
     
     message_list = []
-    for message, sender in messages:
+    for message, sender, reply_message, reply_user in messages:
+        reply_info = None
+        if reply_message is not None and reply_user is not None:
+            reply_info = {
+                "id": reply_message.id,
+                "content": reply_message.content,
+                "sender": {
+                    "id": reply_user.id,
+                    "username": reply_user.username,
+                    "nickname": reply_user.nickname,
+                }
+            }
+        
         data = {
             "id": message.id,
             "content": message.content,
-            "timeSent": message.timeSent.isoformat(),
+            "timeSent": message.timeSent,
             "is_edited": message.is_edited,
-            "edited_at": message.edited_at.isoformat() if message.edited_at else None,
+            "edited_at": message.edited_at,
+            "reply_to": reply_info,
             "sender": {
                 "id": sender.id,
                 "username": sender.username,
@@ -176,47 +232,81 @@ async def get_direct_messages(
         }
         message_list.append(data)
     
-    return {"messages": message_list}
+    return {"messages": message_list, "next_cursor": next_cursor}
+
+
+@router.get("/{user_id}/export")
+async def export_direct_messages(
+    user_id: int,
+    resume: Optional[int] = None,
+    gzip: bool = False,
+    user=Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+):
+    """Stream the whole conversation as NDJSON, oldest first.
+
+    An interrupted download continues with ``resume`` set to the id of the
+    last line received.
+    """
+    other_user = await db.scalar(select(User.id).where(User.id == user_id))
+    if not other_user:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="User not found"
+        )
+    return export_response(export_dm(user.id, user_id, resume), f"dm-{min(user.id, user_id)}_{max(user.id, user_id)}", gzip)
 
 
 @router.get("/conversations")
 async def get_conversations(
+    before: Optional[int] = None,
+    limit: int = Query(settings.dm_page_size, ge=1, le=settings.max_page_size),
     user=Depends(get_current_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
-    conversations = db.query(DirectMessage).filter(
-        or_(
-            DirectMessage.sender_id == user.id,
-            DirectMessage.receiver_id == user.id
-        )
-    ).order_by(desc(DirectMessage.timeSent)).all()
-    
-    conversation_map = {}
-    for dm in conversations:
-        partner_id = dm.receiver_id if dm.sender_id == user.id else dm.sender_id
-        if partner_id not in conversation_map:
-            conversation_map[partner_id] = dm
+    rows = (await db.execute(keyset_paginate(
+        select(DMConversation, User, DirectMessage).join(
+            User, DMConversation.partner_id == User.id
+        ).join(
+            DirectMessage, DMConversation.last_message_id == DirectMessage.id
+        ).where(
+            DMConversation.user_id == user.id
+        ),
+        DMConversation, before=before, limit=limit, sort_column=DMConversation.last_message_at
+    ))).all()
+    conversations, next_cursor = keyset_page(rows, limit)
     
     conversation_list = []
-    for partner_id, latest_message in conversation_map.items():
-        partner = db.query(User).filter(User.id == partner_id).first()
-        if partner:
-            conversation_list.append({
-                "partner": {
-                    "id": partner.id,
-                    "username": partner.username,
-                    "nickname": partner.nickname,
-                    "avatar": partner.avatar,
-                },
-                "latest_message": {
-                    "id": latest_message.id,
-                    "content": latest_message.content,
-                    "timeSent": latest_message.timeSent.isoformat(),
-                    "sender_id": latest_message.sender_id
-                }
-            })
+    for conversation, partner, latest_message in conversations:
+        conversation_list.append({
+            "id": conversation.id,
+            "partner": {
+                "id": partner.id,
+                "username": partner.username,
+                "nickname": partner.nickname,
+                "avatar": partner.avatar,
+            },
+            "latest_message": {
+                "id": latest_message.id,
+                "content": latest_message.content,
+                "timeSent": latest_message.timeSent.isoformat(),
+                "sender_id": latest_message.sender_id
+            },
+            "unread_count": conversation.unread_count
+        })
     
-    return {"conversations": conversation_list}
+    return {"conversations": conversation_list, "next_cursor": next_cursor}
+
+
+@router.post("/{user_id}/read")
+async def mark_conversation_read(
+    user_id: int,
+    user=Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+):
+    await mark_dm_read(db, user.id, user_id)
+    await db.commit()
+    return {"message": "Conversation marked as read"}
 
 
 @router.put("/message/{message_id}/edit")
@@ -224,13 +314,13 @@ async def edit_direct_message(
     message_id: int,
     content: MessageEditForm,
     user=Depends(get_current_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
     # Find the direct message
-    dm = db.query(DirectMessage).filter(
+    dm = await db.scalar(select(DirectMessage).where(
         DirectMessage.id == message_id,
         DirectMessage.is_deleted == False
-    ).first()
+    ))
     
     if not dm:
         raise HTTPException(
@@ -250,11 +340,11 @@ async def edit_direct_message(
     dm.is_edited = True
     dm.edited_at = datetime.now()
     
-    db.commit()
-    db.refresh(dm)
+    await db.commit()
+    await db.refresh(dm)
     
     # Get receiver info for broadcast
-    receiver = db.query(User).filter(User.id == dm.receiver_id).first()
+    receiver = await db.scalar(select(User).where(User.id == dm.receiver_id))
     
     # Prepare updated message for broadcast
     updated_message = {
@@ -280,8 +370,7 @@ async def edit_direct_message(
     
     # Broadcast the edit to DM room
     chat_room_id = f"{min(user.id, dm.receiver_id)}_{max(user.id, dm.receiver_id)}"
-    await broadcast_dm(chat_room_id, updated_message, connected_dm_clients)
-    await connection_manager.broadcast_to_dm(chat_room_id, updated_message)
+    await connection_manager.broadcast_dm_event(chat_room_id, updated_message)
     
     return {"data": updated_message}
 
@@ -290,13 +379,13 @@ async def edit_direct_message(
 async def delete_direct_message(
     message_id: int,
     user=Depends(get_current_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
     # Find the direct message
-    dm = db.query(DirectMessage).filter(
+    dm = await db.scalar(select(DirectMessage).where(
         DirectMessage.id == message_id,
         DirectMessage.is_deleted == False
-    ).first()
+    ))
     
     if not dm:
         raise HTTPException(
@@ -315,10 +404,12 @@ async def delete_direct_message(
     dm.is_deleted = True
     dm.deleted_at = datetime.now()
     
-    db.commit()
+    await db.flush()
+    await record_dm_deleted(db, dm)
+    await db.commit()
     
     # Get receiver info for broadcast
-    receiver = db.query(User).filter(User.id == dm.receiver_id).first()
+    receiver = await db.scalar(select(User).where(User.id == dm.receiver_id))
     
     # Prepare delete notification for broadcast
     delete_notification = {
@@ -341,8 +432,7 @@ async def delete_direct_message(
     
     # Broadcast the deletion to DM room
     chat_room_id = f"{min(user.id, dm.receiver_id)}_{max(user.id, dm.receiver_id)}"
-    await broadcast_dm(chat_room_id, delete_notification, connected_dm_clients)
-    await connection_manager.broadcast_to_dm(chat_room_id, delete_notification)
+    await connection_manager.broadcast_dm_event(chat_room_id, delete_notification)
     
     return MessageDeleteResponse(
         success=True,
@@ -355,11 +445,11 @@ async def delete_direct_message(
 async def delete_conversation(
     user_id: int,
     user=Depends(get_current_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
     """Delete entire conversation with a user"""
     # Check if other user exists
-    other_user = db.query(User).filter(User.id == user_id).first()
+    other_user = await db.scalar(select(User).where(User.id == user_id))
     if not other_user:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -367,14 +457,16 @@ async def delete_conversation(
         )
     
     # Delete all messages between the two users
-    deleted_count = db.query(DirectMessage).filter(
+    result = await db.execute(delete(DirectMessage).where(
         or_(
             and_(DirectMessage.sender_id == user.id, DirectMessage.receiver_id == user_id),
             and_(DirectMessage.sender_id == user_id, DirectMessage.receiver_id == user.id)
         )
-    ).delete()
+    ))
+    deleted_count = result.rowcount
+    await db.execute(delete(DMConversation).where(conversation_pair(user.id, user_id)))
     
-    db.commit()
+    await db.commit()
     
     return {
         "message": f"Conversation deleted successfully. {deleted_count} messages removed.",
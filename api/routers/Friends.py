@@ -1,10 +1,12 @@
 from fastapi import Depends, APIRouter, HTTPException, status
-from sqlalchemy.orm import Session
-from sqlalchemy import or_, and_
+from sqlalchemy import or_, and_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload
 from api.utils.crud import get_db
 from api.models.models import User, Friend
 from api.utils.authentication import get_current_user
 from api.utils.ext import generate_unique_id
+from api.schema.schema import FriendsListResponse
 from datetime import datetime
 
 router = APIRouter(prefix='/friends', tags=['Friends'])
@@ -14,7 +16,7 @@ router = APIRouter(prefix='/friends', tags=['Friends'])
 async def send_friend_request(
     user_id: int,
     current_user=Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     if user_id == current_user.id:
         raise HTTPException(
@@ -22,19 +24,19 @@ async def send_friend_request(
             detail="Cannot send friend request to yourself"
         )
     
-    target_user = db.query(User).filter(User.id == user_id).first()
+    target_user = await db.scalar(select(User).where(User.id == user_id))
     if not target_user:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="User not found"
         )
     
-    existing_friendship = db.query(Friend).filter(
+    existing_friendship = await db.scalar(select(Friend).where(
         or_(
             and_(Friend.user_id == current_user.id, Friend.friend_id == user_id),
             and_(Friend.user_id == user_id, Friend.friend_id == current_user.id)
         )
-    ).first()
+    ))
     
     if existing_friendship:
         if existing_friendship.status == 'accepted':
@@ -61,8 +63,8 @@ async def send_friend_request(
     )
     
     db.add(friend_request)
-    db.commit()
-    db.refresh(friend_request)
+    await db.commit()
+    await db.refresh(friend_request)
     
     return {
         "message": "Friend request sent successfully",
@@ -79,13 +81,13 @@ async def send_friend_request(
 async def accept_friend_request(
     request_id: int,
     current_user=Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    friend_request = db.query(Friend).filter(
+    friend_request = await db.scalar(select(Friend).options(joinedload(Friend.user)).where(
         Friend.friendshipId == request_id,
         Friend.friend_id == current_user.id,
         Friend.status == 'pending'
-    ).first()
+    ))
     
     if not friend_request:
         raise HTTPException(
@@ -104,7 +106,7 @@ async def accept_friend_request(
     )
     
     db.add(reciprocal_friendship)
-    db.commit()
+    await db.commit()
     
     return {
         "message": "Friend request accepted",
@@ -121,14 +123,14 @@ async def accept_friend_request(
 async def reject_friend_request(
     request_id: int,
     current_user=Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Reject a friend request"""
-    friend_request = db.query(Friend).filter(
+    friend_request = await db.scalar(select(Friend).where(
         Friend.friendshipId == request_id,
         Friend.friend_id == current_user.id,
         Friend.status == 'pending'
-    ).first()
+    ))
     
     if not friend_request:
         raise HTTPException(
@@ -138,7 +140,7 @@ async def reject_friend_request(
     
     friend_request.status = 'rejected'
     friend_request.updated_at = datetime.now()
-    db.commit()
+    await db.commit()
     
     return {"message": "Friend request rejected"}
 
@@ -146,13 +148,13 @@ async def reject_friend_request(
 @router.get('/requests')
 async def get_friend_requests(
     current_user=Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Get pending friend requests for current user"""
-    requests = db.query(Friend).filter(
+    requests = (await db.scalars(select(Friend).options(joinedload(Friend.user)).where(
         Friend.friend_id == current_user.id,
         Friend.status == 'pending'
-    ).all()
+    ))).all()
     
     request_list = []
     for request in requests:
@@ -170,16 +172,16 @@ async def get_friend_requests(
     return {"requests": request_list}
 
 
-@router.get('/list')
+@router.get('/list', response_model=FriendsListResponse)
 async def get_friends_list(
     current_user=Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Get list of accepted friends"""
-    friends = db.query(Friend).filter(
+    friends = (await db.scalars(select(Friend).options(joinedload(Friend.friend)).where(
         Friend.user_id == current_user.id,
         Friend.status == 'accepted'
-    ).all()
+    ))).all()
     
     friends_list = []
     for friendship in friends:
@@ -194,7 +196,7 @@ async def get_friends_list(
             },
             "nickname": friendship.nickname,
             "notes": friendship.notes,
-            "since": friendship.created_at.isoformat()
+            "since": friendship.created_at
         })
     
     return {"friends": friends_list}
@@ -204,17 +206,17 @@ async def get_friends_list(
 async def remove_friend(
     friend_id: int,
     current_user=Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Remove a friend (delete friendship)"""
     # Find both directions of the friendship
-    friendships = db.query(Friend).filter(
+    friendships = (await db.scalars(select(Friend).where(
         or_(
             and_(Friend.user_id == current_user.id, Friend.friend_id == friend_id),
             and_(Friend.user_id == friend_id, Friend.friend_id == current_user.id)
         ),
         Friend.status == 'accepted'
-    ).all()
+    ))).all()
     
     if not friendships:
         raise HTTPException(
@@ -224,9 +226,9 @@ async def remove_friend(
     
     # Delete both friendship records
     for friendship in friendships:
-        db.delete(friendship)
+        await db.delete(friendship)
     
-    db.commit()
+    await db.commit()
     
     return {"message": "Friend removed successfully"}
 
@@ -235,7 +237,7 @@ async def remove_friend(
 async def block_user(
     user_id: int,
     current_user=Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Block a user"""
     if user_id == current_user.id:
@@ -245,7 +247,7 @@ async def block_user(
         )
     
     # Check if user exists
-    target_user = db.query(User).filter(User.id == user_id).first()
+    target_user = await db.scalar(select(User).where(User.id == user_id))
     if not target_user:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -253,15 +255,15 @@ async def block_user(
         )
     
     # Remove existing friendship if any
-    existing_friendships = db.query(Friend).filter(
+    existing_friendships = (await db.scalars(select(Friend).where(
         or_(
             and_(Friend.user_id == current_user.id, Friend.friend_id == user_id),
             and_(Friend.user_id == user_id, Friend.friend_id == current_user.id)
         )
-    ).all()
+    ))).all()
     
     for friendship in existing_friendships:
-        db.delete(friendship)
+        await db.delete(friendship)
     
     # Create block record
     block_record = Friend(
@@ -273,7 +275,7 @@ async def block_user(
     )
     
     db.add(block_record)
-    db.commit()
+    await db.commit()
     
     return {"message": "User blocked successfully"}
 
@@ -282,14 +284,14 @@ async def block_user(
 async def unblock_user(
     user_id: int,
     current_user=Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Unblock a user"""
-    block_record = db.query(Friend).filter(
+    block_record = await db.scalar(select(Friend).where(
         Friend.user_id == current_user.id,
         Friend.friend_id == user_id,
         Friend.status == 'blocked'
-    ).first()
+    ))
     
     if not block_record:
         raise HTTPException(
@@ -297,7 +299,7 @@ async def unblock_user(
             detail="Block record not found"
         )
     
-    db.delete(block_record)
-    db.commit()
+    await db.delete(block_record)
+    await db.commit()
     
     return {"message": "User unblocked successfully"}
\ No newline at end of file
@@ -1,15 +1,20 @@
-from fastapi import Depends, APIRouter , HTTPException , status
-from sqlalchemy.orm import Session
+from fastapi import Depends, APIRouter , HTTPException , Query , status
+from sqlalchemy import delete, exists, func, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from api.utils.crud import get_db , get_chat_id_info , group_info
-from api.models.models import User , Group , GroupMember
+from api.models.models import User , Group , GroupMember , ReadState
 from api.utils.authentication import get_current_user
 from api.utils.ext import generate_unique_id
+from api.utils.message_history import publish_history
+from api.utils.read_state import latest_group_message_id, mark_group_read
 from api.schema.schema import GroupCreate 
+from api.config.settings import settings
+from typing import Optional
 
 router = APIRouter(prefix='/group',tags=['Group'])
 @router.post('/create')
-async def create_group(formdata: GroupCreate, current_user=Depends(get_current_user), db: Session=Depends(get_db)):
-    id = generate_unique_id(db)
+async def create_group(formdata: GroupCreate, current_user=Depends(get_current_user), db: AsyncSession=Depends(get_db)):
+    id = generate_unique_id()
     group = Group(
         id=id,
         name=formdata.name,
@@ -17,34 +22,41 @@ async def create_group(formdata: GroupCreate, current_user=Depends(get_current_u
         owner_id=current_user.id
     )
     db.add(group)
-    db.commit()
-    db.refresh(group)
+    await db.commit()
+    await db.refresh(group)
     return {
         'id':group.id,
         'name':group.name,
         'description':group.description,
-        'owner':group.owner.id
+        'owner':group.owner_id
     }
 
 @router.post('/join')
-async def join_group(group_id : int,user = Depends(get_current_user),db : Session = Depends(get_db)):
-    group = db.query(Group).filter(Group.id == group_id).first()
+async def join_group(group_id : int,user = Depends(get_current_user),db : AsyncSession = Depends(get_db)):
+    group = await db.scalar(select(Group).where(Group.id == group_id))
     if not group:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Group not found!")
     
-    checkmember = db.query(GroupMember).filter(GroupMember.group_id == group_id, GroupMember.member_id == user.id).first()
+    checkmember = await db.scalar(select(GroupMember).where(GroupMember.group_id == group_id, GroupMember.member_id == user.id))
     if checkmember:
         raise HTTPException(status_code=status.HTTP_208_ALREADY_REPORTED, detail="You are already a member")
     
     try:
         groupmember = GroupMember(
-            joinId = generate_unique_id(db),
+            joinId = generate_unique_id(),
             member_id = user.id,
             group_id = group.id
         )
         db.add(groupmember)
-        db.commit()
-        db.refresh(groupmember)
+        # Existing history is not counted as unread for new members
+        await db.execute(insert(ReadState).values(
+            member_id=user.id,
+            group_id=group.id,
+            last_read_message_id=latest_group_message_id(group.id),
+            unread_count=0
+        ))
+        await db.commit()
+        await db.refresh(groupmember)
         return {
             "message": "Successfully joined group",
             "group_id": group.id,
@@ -52,22 +64,37 @@ async def join_group(group_id : int,user = Depends(get_current_user),db : Sessio
             "member_id": user.id
         }
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Failed to join group")
 
 @router.get('/list')
-async def get_all_group(user = Depends(get_current_user),db: Session = Depends(get_db)):
-    groups = db.query(Group).all()
+async def get_all_group(
+    after: Optional[int] = None,
+    limit: int = Query(settings.group_page_size, ge=1, le=settings.max_page_size),
+    user = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    # Membership flag and member count are resolved per group inside one query
+    member_count = (
+        select(func.count())
+        .where(GroupMember.group_id == Group.id)
+        .correlate(Group)
+        .scalar_subquery()
+    )
+    is_member = exists().where(
+        GroupMember.group_id == Group.id,
+        GroupMember.member_id == user.id
+    ).correlate(Group)
+    
+    stmt = select(Group, member_count.label("member_count"), is_member.label("is_member"))
+    if after is not None:
+        stmt = stmt.where(Group.id > after)
+    rows = (await db.execute(stmt.order_by(Group.id).limit(limit + 1))).all()
+    
+    next_cursor = rows[limit - 1][0].id if len(rows) > limit else None
     
     groups_with_membership = []
-    for group in groups:
-        is_member = db.query(GroupMember).filter(
-            GroupMember.group_id == group.id,
-            GroupMember.member_id == user.id
-        ).first() is not None
-        
-        member_count = db.query(GroupMember).filter(GroupMember.group_id == group.id).count()
-        
+    for group, member_count, is_member in rows[:limit]:
         group_data = {
             "id": group.id,
             "name": group.name,
@@ -75,31 +102,31 @@ async def get_all_group(user = Depends(get_current_user),db: Session = Depends(g
             "avatar": group.avatar,
             "dateCreated": group.dateCreated,
             "owner_id": group.owner_id,
-            "is_member": is_member,
+            "is_member": bool(is_member),
             "member_count": member_count
         }
         groups_with_membership.append(group_data)
     
-    return groups_with_membership
+    return {"groups": groups_with_membership, "next_cursor": next_cursor}
 
 
 @router.post('/leave/{group_id}')
 async def leave_group(
     group_id: int,
     user=Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    group = db.query(Group).filter(Group.id == group_id).first()
+    group = await db.scalar(select(Group).where(Group.id == group_id))
     if not group:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Group not found"
         )
     
-    membership = db.query(GroupMember).filter(
+    membership = await db.scalar(select(GroupMember).where(
         GroupMember.group_id == group_id,
         GroupMember.member_id == user.id
-    ).first()
+    ))
     
     if not membership:
         raise HTTPException(
@@ -108,10 +135,10 @@ async def leave_group(
         )
     
     if group.owner_id == user.id:
-        other_members = db.query(GroupMember).filter(
+        other_members = await db.scalar(select(func.count()).select_from(GroupMember).where(
             GroupMember.group_id == group_id,
             GroupMember.member_id != user.id
-        ).count()
+        ))
         
         if other_members > 0:
             raise HTTPException(
@@ -119,13 +146,19 @@ async def leave_group(
                 detail="Cannot leave group as owner. Transfer ownership or delete the group."
             )
         else:
-            db.delete(membership)
-            db.delete(group)
-            db.commit()
+            await db.delete(membership)
+            await db.execute(delete(ReadState).where(ReadState.group_id == group_id))
+            await db.delete(group)
+            await db.commit()
+            await publish_history("drop", group_id)
             return {"message": "Group deleted successfully"}
     
-    db.delete(membership)
-    db.commit()
+    await db.delete(membership)
+    await db.execute(delete(ReadState).where(
+        ReadState.group_id == group_id,
+        ReadState.member_id == user.id
+    ))
+    await db.commit()
     
     return {"message": "Left group successfully"}
 
@@ -134,9 +167,9 @@ async def leave_group(
 async def delete_group(
     group_id: int,
     user=Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    group = db.query(Group).filter(Group.id == group_id).first()
+    group = await db.scalar(select(Group).where(Group.id == group_id))
     if not group:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -149,12 +182,37 @@ async def delete_group(
             detail="Only group owner can delete the group"
         )
     
-    db.query(GroupMember).filter(GroupMember.group_id == group_id).delete()
+    await db.execute(delete(GroupMember).where(GroupMember.group_id == group_id))
+    await db.execute(delete(ReadState).where(ReadState.group_id == group_id))
     
     from api.models.models import Message
-    db.query(Message).filter(Message.group_id == group_id).delete()
+    await db.execute(delete(Message).where(Message.group_id == group_id))
     
-    db.delete(group)
-    db.commit()
+    await db.delete(group)
+    await db.commit()
+    await publish_history("drop", group_id)
     
     return {"message": "Group deleted successfully"}
+
+
+@router.post('/read/{group_id}')
+async def mark_group_as_read(
+    group_id: int,
+    message_id: Optional[int] = None,
+    user=Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    membership = await db.scalar(select(GroupMember).where(
+        GroupMember.group_id == group_id,
+        GroupMember.member_id == user.id
+    ))
+    if not membership:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="You are not a member of this group"
+        )
+    
+    await mark_group_read(db, user.id, group_id, message_id)
+    await db.commit()
+    
+    return {"message": "Group marked as read"}
@@ -2,37 +2,46 @@ from fastapi import (
     Depends,
     APIRouter,
     HTTPException,
+    Query,
     status,
     WebSocketDisconnect,
     WebSocket,
 )
-from sqlalchemy.orm import Session
-from sqlalchemy import desc
-from api.utils.crud import get_db, get_id_info, get_chat_id_info
+from sqlalchemy import desc, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+from api.utils.crud import get_db, get_id_info, keyset_paginate, keyset_page
 from api.models.models import User, Message, Group, GroupMember
 from api.utils.authentication import get_current_user, verify_token_access
-from api.utils.ext import generate_unique_id, broadcast
+from api.utils.ext import generate_unique_id
+from api.utils.export import export_group, export_response
+from api.utils.message_history import message_history, publish_history
 from api.utils.websocket_manager import connection_manager
-from api.schema.schema import MessageForm, MessageEditForm, MessageDeleteResponse
-from typing import Dict, List
+from api.utils.read_state import unread_counter, discount_deleted_message
+from api.schema.schema import MessageForm, MessageBatchForm, MessageEditForm, MessageDeleteResponse, GroupMessagePage
+from typing import Dict, List, Optional
 import json
 from datetime import datetime
 import os
 from dotenv import load_dotenv
+from api.config.settings import settings
 
 load_dotenv()
 
 router = APIRouter(tags=['Message'])
-connected_clients: Dict[int, List[WebSocket]] = {}
+# Shared with the manager so broadcasts reach these sockets on every worker
+connected_clients: Dict[int, List[WebSocket]] = connection_manager.chat_connections
 
 
 @router.websocket("/chat/{chatid}")
 async def wsocket(
     chatid: int,
     websocket: WebSocket,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
-    channel = get_id_info(session=db, id=chatid)
+    channel = await get_id_info(session=db, id=chatid)
+    # Hand the pooled connection back; the socket may stay open for hours
+    await db.close()
     if channel is None:
         return HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Chat not found"
@@ -55,7 +64,7 @@ async def wsocket(
         while True:
             data = await websocket.receive_json()
             print(data)
-            await broadcast(chatid, data, connected_clients)
+            await connection_manager.broadcast_to_chat(chatid, data)
     except WebSocketDisconnect:
         print(connected_clients[chatid])
         if chatid in connected_clients and websocket in connected_clients[chatid]:
@@ -68,18 +77,18 @@ async def send_message(
     content: MessageForm,
     reply_to_id: int = None,
     user=Depends(get_current_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
-    group = db.query(Group).filter(Group.id == id).first()
+    group = await db.scalar(select(Group).where(Group.id == id))
     if not group:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Group not found"
         )
     
-    membership = db.query(GroupMember).filter(
+    membership = await db.scalar(select(GroupMember).where(
         GroupMember.group_id == id,
         GroupMember.member_id == user.id
-    ).first()
+    ))
     
     if not membership:
         raise HTTPException(
@@ -87,20 +96,22 @@ async def send_message(
             detail="You must be a member of this group to send messages"
         )
     
-    reply_to_message = None
+    reply_to = None
     if reply_to_id:
-        reply_to_message = db.query(Message).filter(
-            Message.id == reply_to_id,
-            Message.group_id == id,
-            Message.is_deleted == False
-        ).first()
-        if not reply_to_message:
+        reply_to = (await db.execute(
+            select(Message, User).join(User).where(
+                Message.id == reply_to_id,
+                Message.group_id == id,
+                Message.is_deleted == False
+            )
+        )).first()
+        if not reply_to:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="Reply target message not found"
             )
     
-    mid = generate_unique_id(db)
+    mid = generate_unique_id()
     message_content = {"content": content.content}
     
     sendm = Message(
@@ -111,18 +122,21 @@ async def send_message(
         reply_to_id=reply_to_id
     )
     db.add(sendm)
-    db.commit()
-    db.refresh(sendm)
+    # Counted as unread once committed; recounts meanwhile leave it out
+    async with unread_counter.sending(id, user.id, [mid]):
+        await db.commit()
+    await db.refresh(sendm)
     
     reply_info = None
-    if reply_to_message:
+    if reply_to:
+        reply_message, reply_user = reply_to
         reply_info = {
-            "id": reply_to_message.id,
-            "content": reply_to_message.content,
+            "id": reply_message.id,
+            "content": reply_message.content,
             "sender": {
-                "id": reply_to_message.sender.id,
-                "username": reply_to_message.sender.username,
-                "nickname": reply_to_message.sender.nickname,
+                "id": reply_user.id,
+                "username": reply_user.username,
+                "nickname": reply_user.nickname,
             }
         }
     
@@ -143,50 +157,154 @@ async def send_message(
         },
     }
     
-    await broadcast(chatid=id, message=message, channel=connected_clients)
-    await connection_manager.broadcast_to_group(id, message)
+    await connection_manager.broadcast_group_event(id, message)
+    await publish_history("add", id, messages=[{key: value for key, value in message.items() if key != "type"}])
     return {"data": message}
 
 
-@router.get("/{id}/message/fetch")
-async def fetch_message(id: int, db: Session = Depends(get_db)):
-    messagesList = (
-        db.query(Message, User)
-        .join(User)
-        .filter(Message.group_id == id, Message.is_deleted == False)
-        .order_by(desc(Message.timeSent))
-        .limit(25)
-        .all()
-    )
+@router.post("/{id}/message/batch")
+async def send_message_batch(
+    id: int,
+    batch: MessageBatchForm,
+    user=Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+):
+    """Post several messages at once: one membership check, one commit, one frame"""
+    membership = await db.scalar(select(GroupMember).where(
+        GroupMember.group_id == id,
+        GroupMember.member_id == user.id
+    ))
+    if not membership:
+        group = await db.scalar(select(Group.id).where(Group.id == id))
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN if group else status.HTTP_404_NOT_FOUND,
+            detail="You must be a member of this group to send messages" if group else "Group not found"
+        )
+    
+    reply_ids = {item.reply_to_id for item in batch.messages if item.reply_to_id}
+    replies = {}
+    if reply_ids:
+        rows = (await db.execute(
+            select(Message, User).join(User).where(
+                Message.id.in_(reply_ids),
+                Message.group_id == id,
+                Message.is_deleted == False
+            )
+        )).all()
+        replies = {
+            reply_message.id: {
+                "id": reply_message.id,
+                "content": reply_message.content,
+                "sender": {
+                    "id": reply_user.id,
+                    "username": reply_user.username,
+                    "nickname": reply_user.nickname,
+                }
+            }
+            for reply_message, reply_user in rows
+        }
+        missing = reply_ids - replies.keys()
+        if missing:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Reply target message not found: {min(missing)}"
+            )
+    
+    # One timestamp for the batch; the ascending ids keep it in order
+    time_sent = datetime.now()
+    rows = [
+        {
+            "id": generate_unique_id(),
+            "content": {"content": item.content},
+            "sender_id": user.id,
+            "group_id": id,
+            "reply_to_id": item.reply_to_id,
+            "timeSent": time_sent,
+        }
+        for item in batch.messages
+    ]
+    await db.execute(insert(Message), rows)
+    async with unread_counter.sending(id, user.id, [row["id"] for row in rows]):
+        await db.commit()
+    
+    sender = {
+        "id": user.id,
+        "username": user.username,
+        "nickname": user.nickname,
+        "avatar": user.avatar,
+    }
+    messages = [
+        {
+            "id": row["id"],
+            "channelId": id,
+            "content": row["content"],
+            "timeSent": time_sent.isoformat(),
+            "is_edited": False,
+            "edited_at": None,
+            "reply_to": replies.get(row["reply_to_id"]),
+            "user": sender,
+        }
+        for row in rows
+    ]
+    
+    await connection_manager.broadcast_group_event(id, {"type": "new_messages", "channelId": id, "messages": messages})
+    await publish_history("add", id, messages=messages)
+    return {"data": messages}
+
+
+@router.get("/{id}/message/fetch", response_model=GroupMessagePage)
+async def fetch_message(
+    id: int,
+    before: Optional[int] = None,
+    after: Optional[int] = None,
+    limit: int = Query(settings.message_page_size, ge=1, le=settings.max_page_size),
+    db: AsyncSession = Depends(get_db),
+):
+    if before is None and after is None:
+        # Opening a room: usually answered from the buffered newest messages
+        messages, next_cursor = await message_history.first_page(
+            id, limit, lambda size: load_messages(db, id, limit=size)
+        )
+    else:
+        messages, next_cursor = await load_messages(db, id, before=before, after=after, limit=limit)
+    return {"messages": messages, "next_cursor": next_cursor}
+
+
+async def load_messages(db: AsyncSession, group_id: int, before: int = None, after: int = None, limit: int = 25):
+    # Reply targets and their senders come back in the same row as the message
+    ReplyMessage = aliased(Message)
+    ReplyUser = aliased(User)
+    rows = (await db.execute(keyset_paginate(
+        select(Message, User, ReplyMessage, ReplyUser)
+        .join(User, Message.sender_id == User.id)
+        .outerjoin(ReplyMessage, Message.reply_to_id == ReplyMessage.id)
+        .outerjoin(ReplyUser, ReplyMessage.sender_id == ReplyUser.id)
+        .where(Message.group_id == group_id, Message.is_deleted == False),
+        Message, before=before, after=after, limit=limit
+    ))).all()
+    messagesList, next_cursor = keyset_page(rows, limit, after=after)
     messages = []
-    if not get_chat_id_info(id,db):
-        return messages
     
-    for message, user in messagesList:
+    for message, user, reply_message, reply_user in messagesList:
         reply_info = None
-        if message.reply_to_id:
-            reply_to = db.query(Message, User).join(User).filter(
-                Message.id == message.reply_to_id
-            ).first()
-            if reply_to:
-                reply_message, reply_user = reply_to
-                reply_info = {
-                    "id": reply_message.id,
-                    "content": reply_message.content,
-                    "sender": {
-                        "id": reply_user.id,
-                        "username": reply_user.username,
-                        "nickname": reply_user.nickname,
-                    }
+        if reply_message is not None and reply_user is not None:
+            reply_info = {
+                "id": reply_message.id,
+                "content": reply_message.content,
+                "sender": {
+                    "id": reply_user.id,
+                    "username": reply_user.username,
+                    "nickname": reply_user.nickname,
                 }
+            }
         
         data = {
             "id": message.id,
-            "channelId": id,
+            "channelId": group_id,
             "content": message.content,
-            "timeSent": message.timeSent,
+            "timeSent": message.timeSent.isoformat(),
             "is_edited": message.is_edited,
-            "edited_at": message.edited_at,
+            "edited_at": message.edited_at.isoformat() if message.edited_at else None,
             "reply_to": reply_info,
             "user": {
                 "id": user.id,
@@ -196,7 +314,32 @@ async def fetch_message(id: int, db: Session = Depends(get_db)):
             },
         }
         messages.append(data)
-    return messages
+    return messages, next_cursor
+
+
+@router.get("/{id}/message/export")
+async def export_messages(
+    id: int,
+    resume: Optional[int] = None,
+    gzip: bool = False,
+    user=Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+):
+    """Stream the group's whole history as NDJSON, oldest first.
+
+    An interrupted download continues with ``resume`` set to the id of the
+    last line received.
+    """
+    membership = await db.scalar(select(GroupMember).where(
+        GroupMember.group_id == id,
+        GroupMember.member_id == user.id
+    ))
+    if not membership:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="You must be a member of this group to export its messages"
+        )
+    return export_response(export_group(id, resume), f"group-{id}", gzip)
 
 
 @router.put("/message/{message_id}/edit")
@@ -204,13 +347,13 @@ async def edit_message(
     message_id: int,
     content: MessageEditForm,
     user=Depends(get_current_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
     # Find the message
-    message = db.query(Message).filter(
+    message = await db.scalar(select(Message).where(
         Message.id == message_id,
         Message.is_deleted == False
-    ).first()
+    ))
     
     if not message:
         raise HTTPException(
@@ -230,8 +373,8 @@ async def edit_message(
     message.is_edited = True
     message.edited_at = datetime.now()
     
-    db.commit()
-    db.refresh(message)
+    await db.commit()
+    await db.refresh(message)
     
     # Prepare updated message for broadcast
     updated_message = {
@@ -251,8 +394,10 @@ async def edit_message(
     }
     
     # Broadcast the edit to all connected clients
-    await broadcast(chatid=message.group_id, message=updated_message, channel=connected_clients)
-    await connection_manager.broadcast_to_group(message.group_id, updated_message)
+    await connection_manager.broadcast_group_event(message.group_id, updated_message)
+    await publish_history(
+        "edit", message.group_id, id=message.id, content=message.content, edited_at=updated_message["edited_at"]
+    )
     
     return {"data": updated_message}
 
@@ -261,13 +406,13 @@ async def edit_message(
 async def delete_message(
     message_id: int,
     user=Depends(get_current_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
     # Find the message
-    message = db.query(Message).filter(
+    message = await db.scalar(select(Message).where(
         Message.id == message_id,
         Message.is_deleted == False
-    ).first()
+    ))
     
     if not message:
         raise HTTPException(
@@ -286,7 +431,8 @@ async def delete_message(
     message.is_deleted = True
     message.deleted_at = datetime.now()
     
-    db.commit()
+    await discount_deleted_message(db, message)
+    await db.commit()
     
     # Prepare delete notification for broadcast
     delete_notification = {
@@ -303,8 +449,8 @@ async def delete_message(
     }
     
     # Broadcast the deletion to all connected clients
-    await broadcast(chatid=message.group_id, message=delete_notification, channel=connected_clients)
-    await connection_manager.broadcast_to_group(message.group_id, delete_notification)
+    await connection_manager.broadcast_group_event(message.group_id, delete_notification)
+    await publish_history("delete", message.group_id, id=message.id)
     
     return MessageDeleteResponse(
         success=True,
@@ -1,5 +1,5 @@
 from fastapi import Depends, APIRouter, WebSocket, WebSocketDisconnect, HTTPException,status
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from api.utils.crud import get_db, get_id_info
 from api.utils.authentication import get_current_user
 from api.utils.ext import broadcast , connected_clients
@@ -13,9 +13,9 @@ router = APIRouter()
 async def wsocket(
     chatid: int,
     websocket: WebSocket,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
-    channel = get_id_info(session=db ,id=chatid)
+    channel = await get_id_info(session=db ,id=chatid)
     if channel is None:
         return HTTPException(status_code=status.HTTP_404_NOT_FOUND,detail="Chat not found")
     await websocket.accept()
@@ -1,9 +1,12 @@
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from api.utils.crud import get_db
 from api.models.models import User, Group, GroupMember
 from api.utils.authentication import verify_token_access
 from api.utils.websocket_manager import connection_manager
+from api.utils.presence import presence_scope, presence_writer
+from api.utils.read_receipts import read_receipts
 import json
 import logging
 from datetime import datetime
@@ -13,11 +16,18 @@ logger = logging.getLogger(__name__)
 router = APIRouter(tags=['WebSocket'])
 
 
+def record_disconnect(user_id: int, last: bool):
+    """Persist the user as offline once their last socket anywhere is gone"""
+    # Other sockets, here or on another worker, keep the user online
+    if last and not connection_manager.is_user_online(user_id):
+        presence_writer.record_offline(user_id)
+
+
 @router.websocket("/ws/{user_id}")
 async def websocket_endpoint(
     websocket: WebSocket,
     user_id: int,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Main WebSocket endpoint for user connections"""
     try:
@@ -57,19 +67,20 @@ async def websocket_endpoint(
             return
         
         # Get user from database
-        user = db.query(User).filter(User.id == user_id).first()
+        user = await db.scalar(select(User).where(User.id == user_id))
         if not user:
             await websocket.send_json({"error": "User not found"})
             await websocket.close()
             return
         
-        # Connect user
-        await connection_manager.connect_user(websocket, user_id)
+        # Connect user, with presence limited to friends and shared groups
+        scope = await presence_scope(db, user_id)
+        # Hand the pooled connection back; the socket may stay open for hours
+        await db.close()
+        await connection_manager.connect_user(websocket, user_id, scope)
         
-        # Update user status in database
-        user.is_online = True
-        user.status = 1  # online
-        db.commit()
+        # Persisted with the next batched presence flush
+        presence_writer.record_online(user_id)
         
         # Send connection confirmation
         await websocket.send_json({
@@ -78,8 +89,8 @@ async def websocket_endpoint(
             "message": "Connected successfully"
         })
         
-        # Send current online users
-        online_users = connection_manager.get_online_users()
+        # Send which of the users in scope are online
+        online_users = connection_manager.get_online_users(among=scope)
         await websocket.send_json({
             "type": "online_users",
             "users": online_users
@@ -103,54 +114,27 @@ async def websocket_endpoint(
                 elif message_type == 'leave_group':
                     group_id = message.get('group_id')
                     if group_id:
-                        connection_manager.disconnect_from_group(websocket, group_id, user_id)
+                        record_disconnect(user_id, connection_manager.disconnect_from_group(websocket, group_id, user_id))
                 elif message_type == 'join_dm':
                     chat_room_id = message.get('chat_room_id')
                     if chat_room_id:
                         await connection_manager.connect_to_dm(websocket, chat_room_id, user_id)
                 elif message_type == 'typing':
-                    # Handle typing indicators
+                    # Aggregated per room and sent as periodic typing_users frames
                     chat_id = message.get('chat_id')
                     chat_type = message.get('chat_type')  # 'group' or 'dm'
                     is_typing = message.get('is_typing', False)
                     
-                    typing_message = {
-                        "type": "typing",
-                        "user_id": user_id,
-                        "chat_id": chat_id,
-                        "chat_type": chat_type,
-                        "is_typing": is_typing,
-                        "user": {
-                            "id": user.id,
-                            "username": user.username,
-                            "nickname": user.nickname
-                        }
-                    }
-                    
+                    if not chat_id:
+                        continue
                     if chat_type == 'group':
-                        await connection_manager.broadcast_to_group(chat_id, typing_message)
+                        connection_manager.typing.update(f"group:{int(chat_id)}", user, is_typing)
                     elif chat_type == 'dm':
-                        await connection_manager.broadcast_to_dm(str(chat_id), typing_message)
+                        connection_manager.typing.update(f"dm:{chat_id}", user, is_typing)
                 
                 elif message_type == 'message_read':
-                    # Handle message read receipts
-                    message_id = message.get('message_id')
-                    chat_id = message.get('chat_id')
-                    chat_type = message.get('chat_type')
-                    
-                    read_message = {
-                        "type": "message_read",
-                        "message_id": message_id,
-                        "user_id": user_id,
-                        "chat_id": chat_id,
-                        "chat_type": chat_type,
-                        "timestamp": datetime.now().isoformat()
-                    }
-                    
-                    if chat_type == 'group':
-                        await connection_manager.broadcast_to_group(chat_id, read_message)
-                    elif chat_type == 'dm':
-                        await connection_manager.broadcast_to_dm(str(chat_id), read_message)
+                    # Stored and broadcast with the next batch of receipts
+                    read_receipts.record(message.get('chat_type'), message.get('chat_id'), user_id, message.get('message_id'))
                 
             except WebSocketDisconnect:
                 break
@@ -164,19 +148,7 @@ async def websocket_endpoint(
         logger.error(f"WebSocket connection error: {e}")
     finally:
         # Disconnect user
-        await connection_manager.disconnect_user(websocket, user_id)
-        
-        # Update user status in database
-        try:
-            user = db.query(User).filter(User.id == user_id).first()
-            if user:
-                user.is_online = False
-                user.status = 0  # offline
-                from datetime import datetime
-                user.last_seen = datetime.now()
-                db.commit()
-        except Exception as e:
-            logger.error(f"Error updating user status on disconnect: {e}")
+        record_disconnect(user_id, await connection_manager.disconnect_user(websocket, user_id))
 
 
 @router.get("/online-users")
@@ -197,9 +169,10 @@ async def get_user_status(user_id: int):
 async def group_websocket(
     group_id: int,
     websocket: WebSocket,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
     """WebSocket connection for group chats with typing indicators and presence"""
+    connected = False
     try:
         await websocket.accept()
         
@@ -215,23 +188,27 @@ async def group_websocket(
         user_id = user_data.user_id
         
         # Verify user exists and has access to group
-        user = db.query(User).filter(User.id == user_id).first()
+        user = await db.scalar(select(User).where(User.id == user_id))
         if not user:
             await websocket.close(code=4004)
             return
             
         # Check if user is member of the group
-        membership = db.query(GroupMember).filter(
+        membership = await db.scalar(select(GroupMember).where(
             GroupMember.member_id == user_id,
             GroupMember.group_id == group_id
-        ).first()
+        ))
         
         if not membership:
             await websocket.close(code=4003)
             return
+        # Hand the pooled connection back; the socket may stay open for hours
+        await db.close()
         
         # Connect user to group
-        await connection_manager.connect_to_group(websocket, group_id, user_id)
+        if await connection_manager.connect_to_group(websocket, group_id, user_id):
+            presence_writer.record_online(user_id)
+        connected = True
         
         # Notify others that user joined
         join_message = {
@@ -249,10 +226,11 @@ async def group_websocket(
         # Main message loop
         while True:
             data = await websocket.receive_json()
-            await handle_group_message(group_id, user_id, data, db)
+            await handle_group_message(group_id, user, data)
             
     except WebSocketDisconnect:
-        connection_manager.disconnect_from_group(websocket, group_id, user_id)
+        if connected:
+            record_disconnect(user_id, connection_manager.disconnect_from_group(websocket, group_id, user_id))
         
         # Notify others that user left
         if user:
@@ -269,6 +247,8 @@ async def group_websocket(
             await connection_manager.broadcast_to_group(group_id, leave_message)
     except Exception as e:
         logger.error(f"WebSocket error in group {group_id}: {e}")
+        if connected:
+            record_disconnect(user_id, connection_manager.disconnect_from_group(websocket, group_id, user_id))
         await websocket.close(code=1011)
 
 
@@ -276,9 +256,10 @@ async def group_websocket(
 async def dm_websocket(
     user_id: int,
     websocket: WebSocket,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
     """WebSocket connection for direct messages with typing indicators and presence"""
+    connected = False
     try:
         await websocket.accept()
         
@@ -294,18 +275,22 @@ async def dm_websocket(
         current_user_id = current_user_data.user_id
         
         # Verify both users exist
-        current_user = db.query(User).filter(User.id == current_user_id).first()
-        other_user = db.query(User).filter(User.id == user_id).first()
+        current_user = await db.scalar(select(User).where(User.id == current_user_id))
+        other_user = await db.scalar(select(User).where(User.id == user_id))
         
         if not current_user or not other_user:
             await websocket.close(code=4004)
             return
+        # Hand the pooled connection back; the socket may stay open for hours
+        await db.close()
         
         # Create chat room ID
         chat_room_id = f"{min(current_user_id, user_id)}_{max(current_user_id, user_id)}"
         
         # Connect user to DM
-        await connection_manager.connect_to_dm(websocket, chat_room_id, current_user_id)
+        if await connection_manager.connect_to_dm(websocket, chat_room_id, current_user_id):
+            presence_writer.record_online(current_user_id)
+        connected = True
         
         # Notify other user that current user is online
         online_message = {
@@ -323,10 +308,11 @@ async def dm_websocket(
         # Main message loop
         while True:
             data = await websocket.receive_json()
-            await handle_dm_message(chat_room_id, current_user_id, user_id, data, db)
+            await handle_dm_message(chat_room_id, current_user, user_id, data)
             
     except WebSocketDisconnect:
-        connection_manager.disconnect_from_dm(websocket, chat_room_id, current_user_id)
+        if connected:
+            record_disconnect(current_user_id, connection_manager.disconnect_from_dm(websocket, chat_room_id, current_user_id))
         
         # Notify other user that current user went offline
         if current_user:
@@ -343,64 +329,28 @@ async def dm_websocket(
             await connection_manager.send_to_user(user_id, offline_message)
     except Exception as e:
         logger.error(f"WebSocket error in DM {chat_room_id}: {e}")
+        if connected:
+            record_disconnect(current_user_id, connection_manager.disconnect_from_dm(websocket, chat_room_id, current_user_id))
         await websocket.close(code=1011)
 
 
-async def handle_group_message(group_id: int, user_id: int, data: dict, db: Session):
+async def handle_group_message(group_id: int, user: User, data: dict):
     """Handle different types of messages in group chat"""
     message_type = data.get("type", "unknown")
     
-    if message_type == "typing_start":
-        typing_message = {
-            "type": "typing_start",
-            "user_id": user_id,
-            "timestamp": datetime.now().isoformat()
-        }
-        await connection_manager.broadcast_to_group(group_id, typing_message)
-        
-    elif message_type == "typing_stop":
-        typing_message = {
-            "type": "typing_stop",
-            "user_id": user_id,
-            "timestamp": datetime.now().isoformat()
-        }
-        await connection_manager.broadcast_to_group(group_id, typing_message)
+    if message_type in ("typing_start", "typing_stop"):
+        connection_manager.typing.update(f"group:{group_id}", user, message_type == "typing_start")
         
     elif message_type == "message_read":
-        read_message = {
-            "type": "message_read",
-            "message_id": data.get("message_id"),
-            "user_id": user_id,
-            "timestamp": datetime.now().isoformat()
-        }
-        await connection_manager.broadcast_to_group(group_id, read_message)
+        read_receipts.record("group", group_id, user.id, data.get("message_id"))
 
 
-async def handle_dm_message(chat_room_id: str, current_user_id: int, other_user_id: int, data: dict, db: Session):
+async def handle_dm_message(chat_room_id: str, current_user: User, other_user_id: int, data: dict):
     """Handle different types of messages in direct message chat"""
     message_type = data.get("type", "unknown")
     
-    if message_type == "typing_start":
-        typing_message = {
-            "type": "typing_start",
-            "user_id": current_user_id,
-            "timestamp": datetime.now().isoformat()
-        }
-        await connection_manager.broadcast_to_dm(chat_room_id, typing_message)
-        
-    elif message_type == "typing_stop":
-        typing_message = {
-            "type": "typing_stop",
-            "user_id": current_user_id,
-            "timestamp": datetime.now().isoformat()
-        }
-        await connection_manager.broadcast_to_dm(chat_room_id, typing_message)
+    if message_type in ("typing_start", "typing_stop"):
+        connection_manager.typing.update(f"dm:{chat_room_id}", current_user, message_type == "typing_start")
         
     elif message_type == "message_read":
-        read_message = {
-            "type": "message_read",
-            "message_id": data.get("message_id"),
-            "user_id": current_user_id,
-            "timestamp": datetime.now().isoformat()
-        }
-        await connection_manager.broadcast_to_dm(chat_room_id, read_message)
\ No newline at end of file
+        read_receipts.record("dm", chat_room_id, current_user.id, data.get("message_id"))
\ No newline at end of file
@@ -1,7 +1,9 @@
-from typing import Annotated, Optional, Dict
+from typing import Annotated, Optional, Dict, List
 from pydantic import BaseModel, EmailStr, StringConstraints, Field
 from datetime import datetime
 
+from api.config.settings import settings
+
 
 class UserFrom(BaseModel):
     email: EmailStr
@@ -100,6 +102,24 @@ class MessageForm(BaseModel):
         }
 
 
+class MessageBatchItem(MessageForm):
+    reply_to_id: Optional[int] = None
+
+
+class MessageBatchForm(BaseModel):
+    messages: Annotated[List[MessageBatchItem], Field(min_length=1, max_length=settings.message_batch_size)]
+
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "messages": [
+                    {"content": "Build #812 passed"},
+                    {"content": "Deployed to staging", "reply_to_id": 361037250220416}
+                ]
+            }
+        }
+
+
 class MessageEditForm(BaseModel):
     content: Annotated[str, StringConstraints(min_length=1, max_length=400)]
 
@@ -126,6 +146,70 @@ class MessageDeleteResponse(BaseModel):
         }
 
 
+class ReplySender(BaseModel):
+    id: int
+    username: str
+    nickname: str
+
+
+class MessageAuthor(ReplySender):
+    avatar: Optional[str] = None
+
+
+class ReplyPreview(BaseModel):
+    id: int
+    content: dict
+    sender: ReplySender
+
+
+class GroupMessageResponse(BaseModel):
+    id: int
+    channelId: int
+    content: dict
+    timeSent: datetime
+    is_edited: bool
+    edited_at: Optional[datetime] = None
+    reply_to: Optional[ReplyPreview] = None
+    user: MessageAuthor
+
+
+class GroupMessagePage(BaseModel):
+    messages: List[GroupMessageResponse]
+    next_cursor: Optional[int] = None
+
+
+class DirectMessageResponse(BaseModel):
+    id: int
+    content: dict
+    timeSent: datetime
+    is_edited: bool
+    edited_at: Optional[datetime] = None
+    reply_to: Optional[ReplyPreview] = None
+    sender: MessageAuthor
+    receiver_id: int
+
+
+class DirectMessagePage(BaseModel):
+    messages: List[DirectMessageResponse]
+    next_cursor: Optional[int] = None
+
+
+class FriendProfile(MessageAuthor):
+    status: Optional[int] = 0
+
+
+class FriendResponse(BaseModel):
+    id: int
+    friend: FriendProfile
+    nickname: Optional[str] = None
+    notes: Optional[str] = None
+    since: datetime
+
+
+class FriendsListResponse(BaseModel):
+    friends: List[FriendResponse]
+
+
 class PasswordChangeRequest(BaseModel):
     old_password: str
     new_password: Annotated[str, StringConstraints(min_length=8, max_length=128)]
@@ -1,15 +1,20 @@
+from collections import OrderedDict
 from datetime import timedelta, datetime, timezone
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
-from sqlalchemy.orm import Session
-from typing import Optional, Dict, Any
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Optional, Dict, Any, Tuple
+import hashlib
 import logging
+import time
 
 from api.schema.schema import DataToken
 from api.utils.crud import get_db
 from api.models.models import User
 from api.config.settings import settings
+from api.utils.user_cache import cached_user, user_cache
 
 logger = logging.getLogger(__name__)
 
@@ -55,12 +60,62 @@ def create_refresh_token(data: Dict[str, Any]) -> str:
         )
 
 
+class VerifiedTokenCache:
+    """Claims of tokens that already passed verification, kept until their exp.
+
+    Only tokens with a valid signature are stored, so junk tokens cannot
+    push real ones out, and the LRU bound caps memory no matter how many
+    valid tokens are presented. Keys are digests rather than the tokens.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries: "OrderedDict[bytes, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+
+    @staticmethod
+    def _key(token: str) -> bytes:
+        return hashlib.blake2b(token.encode(), digest_size=16).digest()
+
+    def get(self, token: str) -> Optional[Dict[str, Any]]:
+        key = self._key(token)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.time():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, token: str, payload: Dict[str, Any]):
+        if self.max_size <= 0:
+            return
+        key = self._key(token)
+        self.entries[key] = (payload["exp"], payload)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
+verified_tokens = VerifiedTokenCache(settings.token_cache_size)
+
+
 def verify_token(token: str, token_type: str = "access") -> Optional[Dict[str, Any]]:
+    payload = verified_tokens.get(token)
+    if payload is None:
+        payload = _decode_token(token)
+        if payload is None:
+            return None
+        verified_tokens.put(token, payload)
+
+    if payload.get("type") != token_type:
+        return None
+    return payload
+
+
+def _decode_token(token: str) -> Optional[Dict[str, Any]]:
     try:
         payload = jwt.decode(token, settings.jwt_secret_key, algorithms=[settings.jwt_algorithm])
-        
-        if payload.get("type") != token_type:
-            return None
             
         exp = payload.get("exp")
         if exp is None:
@@ -101,9 +156,9 @@ def verify_token_access(token: str, credentials_exception: HTTPException) -> Dat
     )
 
 
-def get_current_user(
+async def get_current_user(
     token: str = Depends(oauth2_scheme), 
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ) -> User:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -119,9 +174,15 @@ def get_current_user(
     if user_id is None:
         raise credentials_exception
 
-    user = db.query(User).filter(User.id == user_id, User.is_deleted == False).first()
+    user = await cached_user(db, user_id)
+    if user is not None:
+        return user
+
+    generation = user_cache.generation
+    user = await db.scalar(select(User).where(User.id == user_id, User.is_deleted == False))
     if user is None:
         raise credentials_exception
+    user_cache.put(user, generation)
         
     return user
 
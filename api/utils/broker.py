@@ -0,0 +1,228 @@
+"""
+Pub/sub transport that lets several workers share WebSocket rooms
+
+Run the relay for multi-worker deployments with
+    python -m api.utils.broker tcp://127.0.0.1:7900
+and point every worker at it through BROKER_URL, giving each its own
+SNOWFLAKE_WORKER_ID.
+"""
+import argparse
+import asyncio
+import logging
+import uuid
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Handler receiving (origin, channels, payload) and returning local fan-out stats
+Deliver = Callable[[str, List[str], str], Awaitable[dict]]
+
+# Control channels, never backed by sockets
+HELLO = "_hello"
+BYE = "_bye"
+# Frames were lost between this worker and its peers; anything kept in step
+# by frames, like the message history buffers, can no longer be trusted
+DROPPED = "_dropped"
+
+MAX_FRAME = 1 << 20
+MAX_BUFFER = 8 << 20
+# Relay frames being delivered to local sockets at once
+MAX_PENDING = 1000
+
+
+def encode_frame(origin: str, channels: List[str], payload: str) -> bytes:
+    # Payloads are compact JSON, which never contains a raw newline
+    return f"{origin} {','.join(channels)} {payload}\n".encode()
+
+
+def decode_frame(line: bytes) -> Tuple[str, List[str], str]:
+    origin, channels, payload = line.decode().rstrip("\n").split(" ", 2)
+    return origin, channels.split(","), payload
+
+
+async def open_stream(url: str):
+    if url.startswith("unix://"):
+        return await asyncio.open_unix_connection(url[len("unix://"):], limit=MAX_FRAME)
+    if url.startswith("tcp://"):
+        host, _, port = url[len("tcp://"):].rpartition(":")
+        return await asyncio.open_connection(host, int(port), limit=MAX_FRAME)
+    raise ValueError(f"Unsupported broker URL: {url}")
+
+
+class Broker:
+    """Delivers published frames to every subscribed worker, this one included"""
+
+    def __init__(self, deliver: Deliver):
+        self.origin = uuid.uuid4().hex[:12]
+        self.deliver = deliver
+
+    async def start(self):
+        pass
+
+    async def publish(self, channels: List[str], payload: str) -> dict:
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class InProcessBroker(Broker):
+    """Single worker: publishing is local delivery"""
+
+    async def publish(self, channels: List[str], payload: str) -> dict:
+        return await self.deliver(self.origin, channels, payload)
+
+
+class SocketBroker(Broker):
+    """Relays frames through a broker process over TCP or a Unix socket.
+
+    Local sockets are served directly and the relay forwards the frame to
+    every other worker. While the relay is unreachable this worker keeps
+    serving its own sockets and reconnects in the background. Each relayed
+    frame is delivered in its own task, so a slow socket never holds up
+    reading the frames behind it.
+    """
+
+    def __init__(self, deliver: Deliver, url: str, reconnect_delay: float = 1.0):
+        super().__init__(deliver)
+        self.url = url
+        self.reconnect_delay = reconnect_delay
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self._task: Optional[asyncio.Task] = None
+        self._pending: Set[asyncio.Task] = set()
+        self._notice: Optional[asyncio.Task] = None
+        # Frames published since the last one that reached the relay were lost
+        self._unsent = False
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def publish(self, channels: List[str], payload: str) -> dict:
+        stats = await self.deliver(self.origin, channels, payload)
+        self._send(encode_frame(self.origin, channels, payload))
+        return stats
+
+    def _send(self, frame: bytes):
+        writer = self.writer
+        if writer is None or writer.is_closing():
+            self._unsent = True
+            return
+        if writer.transport.get_write_buffer_size() > MAX_BUFFER:
+            logger.warning("Broker is not keeping up, dropping frame")
+            self._unsent = True
+            return
+        if self._unsent:
+            # Peers missed what this worker published, ahead of this frame
+            self._unsent = False
+            writer.write(encode_frame(self.origin, [DROPPED], "{}"))
+        writer.write(frame)
+
+    async def _run(self):
+        while True:
+            try:
+                reader, self.writer = await open_stream(self.url)
+                logger.info(f"Connected to broker at {self.url} as {self.origin}")
+                self._send(encode_frame(self.origin, [HELLO], "{}"))
+                await self.deliver(self.origin, [HELLO], "{}")
+                while line := await reader.readline():
+                    self._dispatch(line)
+                logger.warning("Broker closed the connection")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Broker at {self.url} unavailable: {e!r}")
+            finally:
+                if self.writer is not None:
+                    self.writer.close()
+                    self.writer = None
+            await asyncio.sleep(self.reconnect_delay)
+
+    def _dispatch(self, line: bytes):
+        if len(self._pending) >= MAX_PENDING:
+            logger.warning("Sockets are not keeping up, dropping broker frame")
+            # One notice at a time, whatever the number of frames dropped
+            if self._notice is None or self._notice.done():
+                self._notice = self._spawn(encode_frame(self.origin, [DROPPED], "{}"))
+            return
+        self._spawn(line)
+
+    def _spawn(self, line: bytes) -> asyncio.Task:
+        # Tasks start in creation order, so frames begin delivery in the order received
+        task = asyncio.create_task(self._deliver_frame(line))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+        return task
+
+    async def _deliver_frame(self, line: bytes):
+        try:
+            await self.deliver(*decode_frame(line))
+        except Exception as e:
+            logger.error(f"Error delivering broker frame: {e!r}")
+
+    async def close(self):
+        tasks = list(self._pending)
+        if self._task is not None:
+            tasks.append(self._task)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def create_broker(url: str, deliver: Deliver) -> Broker:
+    if not url or url.startswith("memory://"):
+        return InProcessBroker(deliver)
+    return SocketBroker(deliver, url)
+
+
+class BrokerServer:
+    """Forwards every frame to all other connected workers"""
+
+    def __init__(self):
+        self.clients: Dict[asyncio.StreamWriter, Optional[str]] = {}
+
+    def relay(self, source: Optional[asyncio.StreamWriter], frame: bytes):
+        for writer in list(self.clients):
+            if writer is source or writer.is_closing():
+                continue
+            if writer.transport.get_write_buffer_size() > MAX_BUFFER:
+                logger.warning(f"Disconnecting worker {self.clients[writer]}, it is not reading")
+                writer.close()
+                continue
+            writer.write(frame)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.clients[writer] = None
+        try:
+            while line := await reader.readline():
+                if self.clients[writer] is None:
+                    self.clients[writer] = line.split(b" ", 1)[0].decode()
+                    logger.info(f"Worker {self.clients[writer]} connected")
+                self.relay(writer, line)
+        except (ConnectionError, ValueError) as e:
+            logger.warning(f"Dropping worker {self.clients[writer]}: {e!r}")
+        finally:
+            origin = self.clients.pop(writer)
+            writer.close()
+            if origin is not None:
+                logger.info(f"Worker {origin} disconnected")
+                self.relay(None, encode_frame(origin, [BYE], "{}"))
+
+    async def serve(self, url: str):
+        if url.startswith("unix://"):
+            server = await asyncio.start_unix_server(self.handle, url[len("unix://"):], limit=MAX_FRAME)
+        elif url.startswith("tcp://"):
+            host, _, port = url[len("tcp://"):].rpartition(":")
+            server = await asyncio.start_server(self.handle, host, int(port), limit=MAX_FRAME)
+        else:
+            raise ValueError(f"Unsupported broker URL: {url}")
+        logger.info(f"Broker listening on {url}")
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Relay WebSocket broadcasts between chat API workers")
+    parser.add_argument("url", nargs="?", default="tcp://127.0.0.1:7900", help="tcp://host:port or unix:///path")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(BrokerServer().serve(args.url))
@@ -0,0 +1,122 @@
+"""
+Maintenance of the per-participant DM conversation summaries
+"""
+from sqlalchemy import and_, case, desc, or_, select, union_all, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from api.models.models import DirectMessage, DMConversation
+from api.utils.ext import generate_unique_id
+
+
+def conversation_pair(user_id: int, partner_id: int):
+    return or_(
+        and_(DMConversation.user_id == user_id, DMConversation.partner_id == partner_id),
+        and_(DMConversation.user_id == partner_id, DMConversation.partner_id == user_id),
+    )
+
+
+def message_directions(user_id: int, partner_id: int):
+    # Queried one direction at a time, each an index range in time order;
+    # an OR of the two has to sort the whole conversation
+    return [
+        (DirectMessage.sender_id == user_id, DirectMessage.receiver_id == partner_id),
+        (DirectMessage.sender_id == partner_id, DirectMessage.receiver_id == user_id),
+    ]
+
+
+async def record_dm_sent(db: AsyncSession, dm: DirectMessage):
+    """Point both participants' summaries at a flushed message and bump the receiver's unread count"""
+    existing = {
+        conversation.user_id: conversation
+        for conversation in (await db.scalars(
+            select(DMConversation).where(conversation_pair(dm.sender_id, dm.receiver_id))
+        )).all()
+    }
+    for user_id, partner_id in {(dm.sender_id, dm.receiver_id), (dm.receiver_id, dm.sender_id)}:
+        conversation = existing.get(user_id)
+        is_unread = user_id != dm.sender_id
+        if conversation is None:
+            conversation = DMConversation(
+                id=generate_unique_id(),
+                user_id=user_id,
+                partner_id=partner_id,
+                unread_count=1 if is_unread else 0,
+            )
+            db.add(conversation)
+        elif is_unread:
+            # Increment in SQL so concurrent sends don't lose updates
+            conversation.unread_count = DMConversation.unread_count + 1
+        conversation.last_message_id = dm.id
+        conversation.last_message_at = dm.timeSent
+
+
+async def record_dm_deleted(db: AsyncSession, dm: DirectMessage):
+    """Move summaries off a deleted message and drop it from the receiver's unread count"""
+    conversations = (await db.scalars(
+        select(DMConversation).where(conversation_pair(dm.sender_id, dm.receiver_id))
+    )).all()
+    if not conversations:
+        return
+
+    latest = None
+    if any(conversation.last_message_id == dm.id for conversation in conversations):
+        newest = union_all(*(
+            select(DirectMessage.id, DirectMessage.timeSent).where(*direction, DirectMessage.is_deleted == False)
+            for direction in message_directions(dm.sender_id, dm.receiver_id)
+        ))
+        key = newest.selected_columns
+        latest = (await db.execute(newest.order_by(desc(key[1]), desc(key[0])).limit(1))).first()
+
+    for conversation in conversations:
+        if conversation.last_message_id == dm.id:
+            conversation.last_message_id = latest.id if latest else None
+            conversation.last_message_at = latest.timeSent if latest else None
+        was_unread = (
+            conversation.user_id == dm.receiver_id
+            and conversation.user_id != dm.sender_id
+            and (conversation.last_read_message_id is None or dm.id > conversation.last_read_message_id)
+        )
+        if was_unread:
+            conversation.unread_count = case(
+                (DMConversation.unread_count > 0, DMConversation.unread_count - 1),
+                else_=0,
+            )
+
+
+async def mark_dm_read(db: AsyncSession, user_id: int, partner_id: int):
+    await db.execute(
+        update(DMConversation)
+        .where(DMConversation.user_id == user_id, DMConversation.partner_id == partner_id)
+        .values(unread_count=0, last_read_message_id=DMConversation.last_message_id)
+    )
+
+
+def backfill_dm_conversations(db: Session):
+    """Build summaries from existing direct messages the first time the table is created"""
+    if db.scalar(select(DMConversation.id).limit(1)) is not None:
+        return
+
+    latest = {}
+    rows = db.execute(
+        select(DirectMessage.id, DirectMessage.sender_id, DirectMessage.receiver_id, DirectMessage.timeSent)
+        .where(DirectMessage.is_deleted == False)
+        .order_by(DirectMessage.timeSent, DirectMessage.id)
+        .execution_options(yield_per=1000)
+    )
+    for message_id, sender_id, receiver_id, time_sent in rows:
+        latest[(sender_id, receiver_id)] = latest[(receiver_id, sender_id)] = (message_id, time_sent)
+
+    db.add_all(
+        DMConversation(
+            id=generate_unique_id(),
+            user_id=user_id,
+            partner_id=partner_id,
+            last_message_id=message_id,
+            last_message_at=time_sent,
+            last_read_message_id=message_id,
+            unread_count=0,
+        )
+        for (user_id, partner_id), (message_id, time_sent) in latest.items()
+    )
+    db.commit()
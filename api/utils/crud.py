@@ -1,46 +1,106 @@
-from api.db.database import SessionLocal
-from sqlalchemy.orm import Session
-from sqlalchemy import union
+from api.db.database import AsyncSessionLocal
+from sqlalchemy import desc, select, tuple_, union_all
+from sqlalchemy.ext.asyncio import AsyncSession
 from api.models.models import User, Message , Group
 from fastapi import HTTPException, status, Depends
 
-def get_db():
-    try:
-        db = SessionLocal()
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
-def get_id_info(session:Session, id):
-    group = session.query(Group).get(id)
+async def get_id_info(session: AsyncSession, id):
+    group = await session.get(Group, id)
     if group:
         group.type = "group"
         return group
-    user = session.query(User).get(id)
+    user = await session.get(User, id)
     if user:
         user.type = "user"
         return user
-    message = session.query(Message).get(id)
+    message = await session.get(Message, id)
     if message:
         message.type = "message"
         return message
     return None
 
-def get_chat_id_info(id, session):
-    group = session.query(Group).get(id)
+async def get_chat_id_info(id, session: AsyncSession):
+    group = await session.get(Group, id)
     if group:
         group.type = "group"
         return group
-    user = session.query(User).get(id)
+    user = await session.get(User, id)
     if user:
         user.type = "user"
         return user
     return HTTPException(status_code=status.HTTP_404_NOT_FOUND,detail="Chat Not Found!")
 
-def group_info(id: int, session):
-    group = session.query(Group).get(id)
+async def group_info(id: int, session: AsyncSession):
+    group = await session.get(Group, id)
     if group:
         group.type = "group"
         return group
     return HTTPException(status_code=status.HTTP_404_NOT_FOUND,detail="Group Not Found!")
 
+
+def keyset_paginate(stmt, model, before: int = None, after: int = None, limit: int = 25, sort_column=None):
+    """Order a query by (sort_column, id) and seek past the row whose id is the cursor.
+
+    sort_column defaults to model.timeSent. Fetches one row beyond ``limit``
+    so keyset_page can tell if more exist.
+    """
+    sort_column = sort_column if sort_column is not None else model.timeSent
+    stmt = keyset_seek(stmt, model, before, after, sort_column)
+    return stmt.order_by(*keyset_order(sort_column, model.id, after is not None)).limit(limit + 1)
+
+
+def keyset_union(stmt, model, arms, before: int = None, after: int = None, limit: int = 25, sort_column=None, oldest_first: bool = False):
+    """keyset_paginate over rows matching any of ``arms``, each a tuple of WHERE clauses.
+
+    An OR across the arms leaves no index that yields rows in order, so the
+    database collects and sorts every match. Instead each arm seeks its own
+    index range in (sort_column, id) order, the arms are merged until one row
+    beyond ``limit``, and ``stmt`` is joined to that page of ids.
+    ``oldest_first`` reads forward from the start when there is no cursor.
+    """
+    forward = after is not None or oldest_first
+    sort_column = sort_column if sort_column is not None else model.timeSent
+    pages = union_all(*(
+        keyset_seek(select(model.id, sort_column).where(*arm), model, before, after, sort_column)
+        for arm in arms
+    ))
+    key = pages.selected_columns
+    page = pages.order_by(*keyset_order(key[1], key[0], forward)).limit(limit + 1).subquery()
+    return stmt.join(page, model.id == page.c[0]).order_by(*keyset_order(page.c[1], page.c[0], forward))
+
+
+def keyset_seek(stmt, model, before: int = None, after: int = None, sort_column=None):
+    """Restrict a query to the rows past the cursor, in (sort_column, id) order"""
+    if before is not None and after is not None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Use either before or after, not both")
+    sort_column = sort_column if sort_column is not None else model.timeSent
+    if before is not None:
+        anchor = select(sort_column).where(model.id == before).scalar_subquery()
+        stmt = stmt.where(tuple_(sort_column, model.id) < tuple_(anchor, before))
+    elif after is not None:
+        anchor = select(sort_column).where(model.id == after).scalar_subquery()
+        stmt = stmt.where(tuple_(sort_column, model.id) > tuple_(anchor, after))
+    return stmt
+
+
+def keyset_order(sort_column, id_column, forward: bool):
+    # Newest first, except when reading forward, as from an ``after`` cursor
+    if forward:
+        return sort_column, id_column
+    return desc(sort_column), desc(id_column)
+
+
+def keyset_page(rows, limit: int, after: int = None):
+    """Trim the lookahead row from (entity, ...) rows; returns (rows newest first, next_cursor)"""
+    has_more = len(rows) > limit
+    rows = list(rows[:limit])
+    if after is not None:
+        rows.reverse()
+    next_cursor = None
+    if has_more and rows:
+        next_cursor = rows[0][0].id if after is not None else rows[-1][0].id
+    return rows, next_cursor
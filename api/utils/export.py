@@ -0,0 +1,186 @@
+"""
+Streaming NDJSON export of group and direct message history
+
+Export from the command line with
+    python -m api.utils.export group <group_id> -o general.ndjson.gz --gzip
+    python -m api.utils.export dm <user_id> <partner_id>
+    python -m api.utils.export messages
+    python -m api.utils.export direct_messages
+and pick an interrupted export up again with --resume <id of the last line written>.
+Gzip members can be concatenated, so a resumed --gzip export appends to the same file.
+"""
+import argparse
+import asyncio
+import sys
+import zlib
+from typing import AsyncIterator, Optional
+
+import orjson
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select
+from sqlalchemy.orm import aliased
+
+from api.config.settings import settings
+from api.db.database import AsyncSessionLocal
+from api.models.models import DirectMessage, Message, User
+from api.utils.conversations import message_directions
+from api.utils.crud import keyset_seek, keyset_union
+
+Sender = aliased(User)
+
+
+def _group_query(group_id: Optional[int]):
+    stmt = select(
+        Message.id, Message.group_id, Sender.id, Sender.username, Sender.nickname, Message.content,
+        Message.timeSent, Message.is_edited, Message.edited_at, Message.reply_to_id,
+        Message.is_deleted, Message.deleted_at,
+    ).join(Sender, Message.sender_id == Sender.id)
+    if group_id is not None:
+        stmt = stmt.where(Message.group_id == group_id)
+    return stmt
+
+
+def _group_record(row) -> dict:
+    (id, group_id, sender_id, username, nickname, content, time_sent, is_edited, edited_at,
+     reply_to_id, is_deleted, deleted_at) = row
+    return {
+        "id": id,
+        "group_id": group_id,
+        "sender": {"id": sender_id, "username": username, "nickname": nickname},
+        "content": content,
+        "timeSent": time_sent,
+        "is_edited": is_edited,
+        "edited_at": edited_at,
+        "reply_to_id": reply_to_id,
+        "is_deleted": is_deleted,
+        "deleted_at": deleted_at,
+    }
+
+
+def _dm_query():
+    return select(
+        DirectMessage.id, Sender.id, Sender.username, Sender.nickname, DirectMessage.receiver_id,
+        DirectMessage.content, DirectMessage.timeSent, DirectMessage.is_edited, DirectMessage.edited_at,
+        DirectMessage.reply_to_id, DirectMessage.is_deleted, DirectMessage.deleted_at,
+    ).join(Sender, DirectMessage.sender_id == Sender.id)
+
+
+def _dm_record(row) -> dict:
+    (id, sender_id, username, nickname, receiver_id, content, time_sent, is_edited, edited_at,
+     reply_to_id, is_deleted, deleted_at) = row
+    return {
+        "id": id,
+        "sender": {"id": sender_id, "username": username, "nickname": nickname},
+        "receiver_id": receiver_id,
+        "content": content,
+        "timeSent": time_sent,
+        "is_edited": is_edited,
+        "edited_at": edited_at,
+        "reply_to_id": reply_to_id,
+        "is_deleted": is_deleted,
+        "deleted_at": deleted_at,
+    }
+
+
+async def _export(stmt, model, record, resume: Optional[int], include_deleted: bool, sort_column=None, arms=None) -> AsyncIterator[bytes]:
+    deleted = () if include_deleted else (model.is_deleted == False,)
+    sort_column = sort_column if sort_column is not None else model.timeSent
+    size = settings.export_batch_size
+    after = resume
+    async with AsyncSessionLocal() as db:
+        while True:
+            if arms is None:
+                batch = keyset_seek(stmt.where(*deleted), model, after=after, sort_column=sort_column)
+                batch = batch.order_by(sort_column, model.id).limit(size)
+            else:
+                # One index seek per arm; keyset_union reads one row past its limit
+                batch = keyset_union(
+                    stmt, model, [(*arm, *deleted) for arm in arms],
+                    after=after, limit=size - 1, sort_column=sort_column, oldest_first=True,
+                )
+            lines = []
+            async for row in await db.stream(batch):
+                lines.append(orjson.dumps(record(row)) + b"\n")
+                after = row[0]
+            # Each batch is its own short read, so writers are never held up
+            # for the length of an export
+            await db.commit()
+            if lines:
+                yield b"".join(lines)
+            if len(lines) < size:
+                return
+
+
+def export_group(group_id: int, resume: Optional[int] = None, include_deleted: bool = False) -> AsyncIterator[bytes]:
+    """NDJSON chunks of a group's messages, oldest first, starting after message ``resume``"""
+    return _export(_group_query(group_id), Message, _group_record, resume, include_deleted)
+
+
+def export_dm(user_id: int, partner_id: int, resume: Optional[int] = None, include_deleted: bool = False) -> AsyncIterator[bytes]:
+    """NDJSON chunks of a conversation, oldest first, starting after message ``resume``"""
+    arms = message_directions(user_id, partner_id)
+    return _export(_dm_query(), DirectMessage, _dm_record, resume, include_deleted, arms=arms)
+
+
+def export_table(table: str, resume: Optional[int] = None, include_deleted: bool = False) -> AsyncIterator[bytes]:
+    """Every group or direct message in primary key order, for backups"""
+    if table == "messages":
+        return _export(_group_query(None), Message, _group_record, resume, include_deleted, sort_column=Message.id)
+    return _export(_dm_query(), DirectMessage, _dm_record, resume, include_deleted, sort_column=DirectMessage.id)
+
+
+async def gzipped(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    async for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def export_response(chunks: AsyncIterator[bytes], name: str, compress: bool) -> StreamingResponse:
+    if compress:
+        return StreamingResponse(
+            gzipped(chunks),
+            media_type="application/gzip",
+            headers={"Content-Disposition": f'attachment; filename="{name}.ndjson.gz"'},
+        )
+    return StreamingResponse(
+        chunks,
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{name}.ndjson"'},
+    )
+
+
+async def _main(args):
+    if args.kind == "group":
+        chunks = export_group(args.ids[0], args.resume, args.include_deleted)
+    elif args.kind == "dm":
+        chunks = export_dm(args.ids[0], args.ids[1], args.resume, args.include_deleted)
+    else:
+        chunks = export_table(args.kind, args.resume, args.include_deleted)
+    if args.gzip:
+        chunks = gzipped(chunks)
+    # Appending lets --resume continue a plain NDJSON file in place
+    out = open(args.output, "ab") if args.output else sys.stdout.buffer
+    try:
+        async for chunk in chunks:
+            out.write(chunk)
+    finally:
+        if args.output:
+            out.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export chat history as NDJSON")
+    parser.add_argument("kind", choices=["group", "dm", "messages", "direct_messages"])
+    parser.add_argument("ids", nargs="*", type=int, help="group id, or the two user ids of a conversation")
+    parser.add_argument("-o", "--output", help="file to append to, stdout by default")
+    parser.add_argument("--gzip", action="store_true", help="gzip the output")
+    parser.add_argument("--resume", type=int, help="id of the last message already exported")
+    parser.add_argument("--include-deleted", action="store_true", help="also export soft-deleted messages")
+    args = parser.parse_args()
+    expected = {"group": 1, "dm": 2}.get(args.kind, 0)
+    if len(args.ids) != expected:
+        parser.error(f"{args.kind} takes {expected} id(s)")
+    asyncio.run(_main(args))
@@ -1,22 +1,11 @@
-import random
 from fastapi import WebSocket , HTTPException , status
 from typing import Dict , List
-from sqlalchemy.orm  import Session
-from api.models.models import User , Message ,Group
+from api.utils.snowflake import snowflake
+from api.utils.websocket_manager import fan_out
 
-def generate_unique_id(session: Session) -> int:
-    while True:
-        generated_id = random.randint(1000000000, 9999999999)
-        existing_records = session.query(User.id).filter(User.id == generated_id). \
-            union(session.query(Message.id).filter(Message.id == generated_id)). \
-            union(session.query(Group.id).filter(Group.id == generated_id)).all()
-        if not existing_records:
-            return generated_id
+def generate_unique_id() -> int:
+    return snowflake.next_id()
 
 async def broadcast(chatid:int , message: dict , channel:Dict[int,List[WebSocket]]):
     if chatid in channel:
-        for websocket in channel[chatid]:
-            try:
-                await websocket.send_json(message)
-            except Exception as e:
-                print(f"Failed to send message to websocket: {e}")
\ No newline at end of file
+        await fan_out(channel[chatid], message, f"chat {chatid}")
\ No newline at end of file
@@ -0,0 +1,246 @@
+"""
+Newest messages of active groups, kept in memory to serve first pages
+"""
+import logging
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+import orjson
+
+from api.config.settings import settings
+from api.utils.broker import DROPPED, HELLO
+from api.utils.user_cache import USER_CHANGED
+from api.utils.websocket_manager import connection_manager
+
+logger = logging.getLogger(__name__)
+
+HISTORY = "_history"
+
+# Rough cost in bytes of the dict, tuple and deque slot behind each buffered
+# message, and of a group's own buffer, on top of the serialized messages
+ENTRY_OVERHEAD = 400
+GROUP_OVERHEAD = 1000
+
+# Fetches the newest ``size`` messages of a group: (entries newest first, next_cursor)
+Loader = Callable[[int], Awaitable[Tuple[List[dict], Optional[int]]]]
+
+
+def _key(entry: dict) -> Tuple[str, int]:
+    # Same order as keyset_paginate: (timeSent, id)
+    return entry["timeSent"], entry["id"]
+
+
+def _size(entry: dict) -> int:
+    return len(orjson.dumps(entry)) + ENTRY_OVERHEAD
+
+
+class GroupHistory:
+    """Ring buffer of one group's newest messages, oldest first"""
+
+    def __init__(self, entries: List[dict], complete: bool):
+        self.entries: Deque[Tuple[int, dict]] = deque((_size(entry), entry) for entry in entries)
+        # True when the buffer holds every message of the group
+        self.complete = complete
+        self.bytes = GROUP_OVERHEAD + sum(size for size, _ in self.entries)
+
+
+class MessageHistory:
+    """Keeps the newest ``size`` serialized messages of each active group.
+
+    A first page is served from the buffer when it holds enough messages;
+    the first miss loads one from the database. Sends, edits and deletes
+    are published on the broker and applied by every worker, so buffers
+    stay in step with the rooms' WebSocket frames; every buffer is cleared
+    when frames may have been lost on the way. Groups are kept in LRU
+    order and the least recently read are dropped beyond ``max_bytes`` or
+    ``max_groups``. Groups without messages are never buffered, so unknown
+    ids cannot fill the cache.
+    """
+
+    def __init__(self, size: int, max_bytes: int, max_groups: int):
+        self.size = size
+        self.max_bytes = max_bytes
+        self.max_groups = max_groups
+        self.groups: "OrderedDict[int, GroupHistory]" = OrderedDict()
+        self.bytes = 0
+        # Group -> [loads in flight, changes applied since the first began]
+        self.loading: Dict[int, List[int]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def first_page(self, group_id: int, limit: int, load: Loader) -> Tuple[List[dict], Optional[int]]:
+        """The newest ``limit`` messages, newest first, and the cursor of the next page"""
+        if limit > self.size:
+            return await load(limit)
+        page = self._page(group_id, limit)
+        if page is not None:
+            self.hits += 1
+            return page
+        self.misses += 1
+
+        state = self.loading.setdefault(group_id, [0, 0])
+        state[0] += 1
+        version = state[1]
+        try:
+            entries, next_cursor = await load(self.size)
+        finally:
+            state[0] -= 1
+            if not state[0]:
+                del self.loading[group_id]
+        # A message applied while loading may be missing from the rows, and an
+        # empty result may as well be a group that does not exist
+        if entries and state[1] == version:
+            self._install(group_id, GroupHistory(entries[::-1], next_cursor is None))
+        return self._slice(entries, limit, next_cursor)
+
+    def _page(self, group_id: int, limit: int):
+        history = self.groups.get(group_id)
+        if history is None:
+            return None
+        entries = history.entries
+        if len(entries) <= limit and not history.complete:
+            # Deletes left too few to tell whether another page exists
+            return None
+        self.groups.move_to_end(group_id)
+        newest = [entry for _, entry in reversed(entries)]
+        return self._slice(newest, limit, None)
+
+    @staticmethod
+    def _slice(entries: List[dict], limit: int, next_cursor: Optional[int]):
+        if len(entries) > limit:
+            return entries[:limit], entries[limit - 1]["id"]
+        return entries, next_cursor
+
+    def _install(self, group_id: int, history: GroupHistory):
+        self.drop(group_id)
+        self.groups[group_id] = history
+        self.bytes += history.bytes
+        while (self.bytes > self.max_bytes or len(self.groups) > self.max_groups) and self.groups:
+            self.drop(next(iter(self.groups)))
+
+    def drop(self, group_id: int):
+        history = self.groups.pop(group_id, None)
+        if history is not None:
+            self.bytes -= history.bytes
+
+    def _changed(self, group_id: int) -> Optional[GroupHistory]:
+        state = self.loading.get(group_id)
+        if state is not None:
+            state[1] += 1
+        return self.groups.get(group_id)
+
+    def add(self, group_id: int, entry: dict):
+        history = self._changed(group_id)
+        if history is None:
+            return
+        entries = history.entries
+        if any(existing["id"] == entry["id"] for _, existing in entries):
+            return
+        size = _size(entry)
+        if not entries or _key(entry) >= _key(entries[-1][1]):
+            entries.append((size, entry))
+        else:
+            # Arrived out of order from another worker
+            position = next(i for i, (_, existing) in enumerate(entries) if _key(existing) > _key(entry))
+            entries.insert(position, (size, entry))
+        history.bytes += size
+        self.bytes += size
+        while len(entries) > self.size:
+            dropped, _ = entries.popleft()
+            history.bytes -= dropped
+            self.bytes -= dropped
+            history.complete = False
+        while self.bytes > self.max_bytes and len(self.groups) > 1:
+            self.drop(next(iter(self.groups)))
+
+    def edit(self, group_id: int, message_id: int, content: dict, edited_at: str):
+        history = self._changed(group_id)
+        if history is None:
+            return
+        for index, (size, entry) in enumerate(history.entries):
+            if entry["id"] == message_id:
+                entry = {**entry, "content": content, "is_edited": True, "edited_at": edited_at}
+            elif entry["reply_to"] is not None and entry["reply_to"]["id"] == message_id:
+                entry = {**entry, "reply_to": {**entry["reply_to"], "content": content}}
+            else:
+                continue
+            new_size = _size(entry)
+            history.entries[index] = (new_size, entry)
+            history.bytes += new_size - size
+            self.bytes += new_size - size
+
+    def delete(self, group_id: int, message_id: int):
+        history = self._changed(group_id)
+        if history is None:
+            return
+        for size, entry in history.entries:
+            if entry["id"] == message_id:
+                history.entries.remove((size, entry))
+                history.bytes -= size
+                self.bytes -= size
+                return
+
+    def forget_user(self, user_id: int):
+        """Drop the groups showing a user whose profile changed"""
+        for state in self.loading.values():
+            state[1] += 1
+        for group_id, history in list(self.groups.items()):
+            for _, entry in history.entries:
+                if entry["user"]["id"] == user_id or (
+                    entry["reply_to"] is not None and entry["reply_to"]["sender"]["id"] == user_id
+                ):
+                    self.drop(group_id)
+                    break
+
+    def clear(self):
+        for state in self.loading.values():
+            state[1] += 1
+        self.groups.clear()
+        self.bytes = 0
+
+    def receive(self, origin: str, payload: str):
+        update = orjson.loads(payload)
+        op, group_id = update["op"], update["group"]
+        if op == "add":
+            for entry in update["messages"]:
+                self.add(group_id, entry)
+        elif op == "edit":
+            self.edit(group_id, update["id"], update["content"], update["edited_at"])
+        elif op == "delete":
+            self.delete(group_id, update["id"])
+        elif op == "drop":
+            self._changed(group_id)
+            self.drop(group_id)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "groups": len(self.groups),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "max_groups": self.max_groups,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+message_history = MessageHistory(settings.history_cache_size, settings.history_cache_bytes, settings.history_cache_groups)
+connection_manager.on_control(HISTORY, message_history.receive)
+connection_manager.on_control(USER_CHANGED, lambda origin, payload: message_history.forget_user(int(payload)))
+
+
+def _rejoined(origin: str, payload: str):
+    # Updates published while disconnected from the broker never arrived
+    if origin == connection_manager.broker.origin:
+        message_history.clear()
+
+
+connection_manager.on_control(HELLO, _rejoined)
+# A dropped edit or delete would otherwise be served until the group is evicted
+connection_manager.on_control(DROPPED, lambda origin, payload: message_history.clear())
+
+
+async def publish_history(op: str, group_id: int, **fields):
+    """Apply a change to the buffered history of a group on every worker"""
+    await connection_manager.broker.publish([HISTORY], orjson.dumps({"op": op, "group": group_id, **fields}).decode())
@@ -0,0 +1,142 @@
+"""
+bcrypt on a dedicated, bounded thread pool, at a cost calibrated for this host
+"""
+import asyncio
+import logging
+import math
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+
+import bcrypt
+from fastapi import HTTPException, status
+from sqlalchemy import update
+
+from api.config.settings import settings
+from api.db.database import AsyncSessionLocal
+from api.models.models import User
+from api.utils.user_cache import invalidate_user
+
+logger = logging.getLogger(__name__)
+
+CALIBRATION_ROUNDS = 8
+
+
+def hash_password(password: str, rounds: Optional[int] = None) -> str:
+    salt = bcrypt.gensalt(rounds=rounds or settings.bcrypt_rounds)
+    return bcrypt.hashpw(password.encode('utf-8'), salt).decode('utf-8')
+
+
+def verify_password(password: str, hashed_password: str) -> bool:
+    return bcrypt.checkpw(password.encode('utf-8'), hashed_password.encode('utf-8'))
+
+
+def hash_cost(hashed_password: str) -> int:
+    # $2b$<cost>$<salt+hash>
+    return int(hashed_password.split("$")[2])
+
+
+def _time_hash(rounds: int) -> float:
+    started = time.perf_counter()
+    hash_password("calibration", rounds)
+    return time.perf_counter() - started
+
+
+class PasswordHasher:
+    """Runs bcrypt off the event loop so sockets keep flowing during logins.
+
+    At most ``workers`` hashes run at once and at most ``queue_limit`` more
+    wait for a thread; past that callers get a 503 instead of queueing up.
+    bcrypt releases the GIL while hashing, so the threads run in parallel.
+    """
+
+    def __init__(self, workers: int, queue_limit: int, rounds: int):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self.capacity = workers + queue_limit
+        self.in_flight = 0
+        self.rounds = rounds
+        # One pending rehash per user, however often they log in meanwhile
+        self._rehashes: Dict[int, asyncio.Task] = {}
+
+    def _release(self, loop: asyncio.AbstractEventLoop):
+        # Called from the worker thread once the job is really finished
+        loop.call_soon_threadsafe(self._decrement)
+
+    def _decrement(self):
+        self.in_flight -= 1
+
+    async def _run(self, fn, *args):
+        if self.in_flight >= self.capacity:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many authentication requests, try again shortly",
+                headers={"Retry-After": "1"},
+            )
+        loop = asyncio.get_running_loop()
+        self.in_flight += 1
+        future = self.executor.submit(fn, *args)
+        future.add_done_callback(lambda _: self._release(loop))
+        return await asyncio.wrap_future(future)
+
+    async def hash(self, password: str) -> str:
+        return await self._run(hash_password, password, self.rounds)
+
+    async def verify(self, password: str, hashed_password: str) -> bool:
+        return await self._run(verify_password, password, hashed_password)
+
+    async def calibrate(self, target_ms: float, min_rounds: int, max_rounds: int) -> int:
+        """Pick the cost whose hash takes closest to, without exceeding, ``target_ms``"""
+        # Each extra round doubles the work, so time a cheap cost and extrapolate
+        elapsed = min([await self._run(_time_hash, CALIBRATION_ROUNDS) for _ in range(3)])
+        rounds = CALIBRATION_ROUNDS + math.floor(math.log2(target_ms / 1000 / elapsed))
+        self.rounds = max(min_rounds, min(max_rounds, rounds))
+        logger.info(
+            f"bcrypt cost {self.rounds}: ~{elapsed * 2 ** (self.rounds - CALIBRATION_ROUNDS) * 1000:.0f} ms "
+            f"per hash for a {target_ms:.0f} ms budget"
+        )
+        return self.rounds
+
+    def needs_rehash(self, hashed_password: str) -> bool:
+        cost = hash_cost(hashed_password)
+        # Only step down for a clear gap, so workers whose calibration lands
+        # one round apart don't rehash the same password back and forth
+        return cost < self.rounds or cost > self.rounds + 1
+
+    def rehash_later(self, user_id: int, password: str, hashed_password: str):
+        """Store the password at the current cost, after the login has answered"""
+        if user_id in self._rehashes:
+            return
+        task = asyncio.create_task(self._rehash(user_id, password, hashed_password))
+        self._rehashes[user_id] = task
+        task.add_done_callback(lambda _: self._rehashes.pop(user_id, None))
+
+    async def _rehash(self, user_id: int, password: str, hashed_password: str):
+        try:
+            new_hash = await self.hash(password)
+            async with AsyncSessionLocal() as db:
+                # Leave it alone if the password changed in the meantime
+                result = await db.execute(
+                    update(User)
+                    .where(User.id == user_id, User.hashed_password == hashed_password)
+                    .values(hashed_password=new_hash)
+                )
+                await db.commit()
+            if result.rowcount:
+                await invalidate_user(user_id)
+                logger.info(f"Rehashed password of user {user_id} from cost {hash_cost(hashed_password)} to {self.rounds}")
+        except HTTPException:
+            # Hasher saturated, the next login will try again
+            pass
+        except Exception as e:
+            logger.error(f"Failed to rehash password of user {user_id}: {e}")
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+password_hasher = PasswordHasher(
+    settings.bcrypt_workers or min(4, os.cpu_count() or 1),
+    settings.bcrypt_queue_limit,
+    settings.bcrypt_rounds,
+)
@@ -0,0 +1,85 @@
+"""
+Presence scoping and write-behind persistence of the users' online state
+"""
+import asyncio
+import logging
+from datetime import datetime
+from typing import Dict, Optional, Set
+
+from sqlalchemy import bindparam, select, union_all, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from api.db.database import AsyncSessionLocal
+from api.models.models import Friend, GroupMember, User
+
+logger = logging.getLogger(__name__)
+
+users = User.__table__
+
+
+async def presence_scope(db: AsyncSession, user_id: int) -> Set[int]:
+    """Accepted friends and members of shared groups, in one query"""
+    shared_groups = select(GroupMember.group_id).where(GroupMember.member_id == user_id)
+    # Duplicates collapse in the set; UNION would sort every row to drop them
+    scope = union_all(
+        select(Friend.friend_id).where(Friend.user_id == user_id, Friend.status == 'accepted'),
+        select(GroupMember.member_id).where(GroupMember.group_id.in_(shared_groups)),
+    )
+    scoped = set((await db.scalars(scope)).all())
+    scoped.discard(user_id)
+    return scoped
+
+
+class PresenceWriter:
+    """Keeps the latest online state per user and writes it in batched UPDATEs.
+
+    Connects and disconnects only touch memory; ``last_seen`` is the time of
+    the disconnect, not of the flush.
+    """
+
+    def __init__(self):
+        # user_id -> None while online, or the time they went offline
+        self.pending: Dict[int, Optional[datetime]] = {}
+        self._lock = asyncio.Lock()
+
+    def record_online(self, user_id: int):
+        self.pending[user_id] = None
+
+    def record_offline(self, user_id: int, at: Optional[datetime] = None):
+        self.pending[user_id] = at or datetime.now()
+
+    async def flush(self):
+        async with self._lock:
+            if not self.pending:
+                return
+            pending, self.pending = self.pending, {}
+            online = [{"b_id": user_id} for user_id, seen in pending.items() if seen is None]
+            offline = [{"b_id": user_id, "b_last_seen": seen} for user_id, seen in pending.items() if seen is not None]
+            try:
+                async with AsyncSessionLocal() as db:
+                    if online:
+                        await db.execute(
+                            update(users).where(users.c.id == bindparam("b_id")).values(is_online=True, status=1),
+                            online,
+                        )
+                    if offline:
+                        await db.execute(
+                            update(users)
+                            .where(users.c.id == bindparam("b_id"))
+                            .values(is_online=False, status=0, last_seen=bindparam("b_last_seen")),
+                            offline,
+                        )
+                    await db.commit()
+            except Exception as e:
+                logger.error(f"Failed to flush presence: {e}")
+                # Keep anything recorded since, it is newer
+                for user_id, seen in pending.items():
+                    self.pending.setdefault(user_id, seen)
+
+    async def run(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush()
+
+
+presence_writer = PresenceWriter()
@@ -0,0 +1,210 @@
+"""
+Per-client request limits with constant work per request and bounded memory
+"""
+import asyncio
+import logging
+import math
+import time
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+
+import orjson
+
+from api.config.settings import settings
+from api.utils.websocket_manager import connection_manager
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT = "_rate_limit"
+
+
+class RateLimiter:
+    """Decides whether a client may make another request"""
+
+    async def hit(self, key: str) -> Tuple[float, bool]:
+        """Count a request.
+
+        Returns 0 if it is allowed, otherwise the seconds until the client may
+        retry, along with whether the client is blocked outright.
+        """
+        raise NotImplementedError
+
+    async def run(self, interval: float):
+        pass
+
+
+class SlidingWindowLimiter(RateLimiter):
+    """Sliding-window counter kept in this process.
+
+    Each client holds the allowed requests of the current and previous
+    fixed windows; the previous one is weighted by how much of it still
+    overlaps the sliding window. A client refused ``limit`` more times
+    within one window is blocked for ``block_seconds``.
+
+    Clients are kept in LRU order and dropped once idle for two windows,
+    when their counts no longer matter, or beyond ``max_clients``.
+    """
+
+    def __init__(self, limit: int, window: float, block_seconds: float, max_clients: int):
+        self.limit = limit
+        self.window = window
+        self.block_seconds = block_seconds
+        self.max_clients = max_clients
+        # key -> [window index, allowed in it, allowed in the one before, refused in it]
+        self.clients: "OrderedDict[str, List[int]]" = OrderedDict()
+        # key -> wall-clock end of the block, in the order blocks were placed
+        self.blocked: "OrderedDict[str, float]" = OrderedDict()
+
+    async def hit(self, key: str) -> Tuple[float, bool]:
+        now = time.time()
+        retry_after = self._check_block(key, now)
+        if retry_after:
+            return retry_after, True
+
+        index, offset = divmod(now, self.window)
+        entry = self._entry(key, int(index))
+        estimate = entry[2] * (1 - offset / self.window) + entry[1]
+        if estimate < self.limit:
+            entry[1] += 1
+            self._allowed(key, entry[0])
+            return 0, False
+
+        entry[3] += 1
+        if entry[3] >= self.limit:
+            self._block(key, now + self.block_seconds)
+            return self.block_seconds, True
+        # When enough of the previous window has slid out to admit one more
+        if entry[1] < self.limit:
+            return (1 - (self.limit - entry[1]) / entry[2]) * self.window - offset, False
+        return self.window - offset + (1 - self.limit / entry[1]) * self.window, False
+
+    def _check_block(self, key: str, now: float) -> float:
+        until = self.blocked.get(key)
+        if until is None:
+            return 0
+        if until > now:
+            return until - now
+        del self.blocked[key]
+        return 0
+
+    def _entry(self, key: str, index: int) -> List[int]:
+        entry = self.clients.get(key)
+        if entry is None:
+            entry = self.clients[key] = [index, 0, 0, 0]
+            self._evict(index)
+        else:
+            self.clients.move_to_end(key)
+            self._roll(entry, index)
+        return entry
+
+    @staticmethod
+    def _roll(entry: List[int], index: int):
+        if entry[0] == index:
+            return
+        entry[2] = entry[1] if entry[0] == index - 1 else 0
+        entry[1] = entry[3] = 0
+        entry[0] = index
+
+    def _evict(self, index: int):
+        clients = self.clients
+        while len(clients) > self.max_clients:
+            clients.popitem(last=False)
+        # Least recently seen first, so stop at the first one still counting
+        for _ in range(2):
+            key = next(iter(clients))
+            if clients[key][0] >= index - 1:
+                break
+            del clients[key]
+
+    def _block(self, key: str, until: float):
+        logger.warning(f"Blocking {key} for {until - time.time():.0f}s after repeated rate limit violations")
+        self.blocked[key] = until
+        self.blocked.move_to_end(key)
+        self.clients.pop(key, None)
+        now = time.time()
+        while self.blocked and (len(self.blocked) > self.max_clients or next(iter(self.blocked.values())) <= now):
+            self.blocked.popitem(last=False)
+
+    def _allowed(self, key: str, index: int):
+        pass
+
+
+class SharedSlidingWindowLimiter(SlidingWindowLimiter):
+    """Sliding-window counter whose counts and blocks are shared through the broker.
+
+    Every ``interval`` each worker publishes the requests it allowed since
+    the last exchange, and peers add them to their own counts. Windows are
+    aligned on wall-clock time so every worker agrees on them; a client
+    spreading requests across workers can overshoot by at most what they
+    admit within one interval.
+    """
+
+    def __init__(self, broker, limit: int, window: float, block_seconds: float, max_clients: int):
+        super().__init__(limit, window, block_seconds, max_clients)
+        self.broker = broker
+        # Window index -> key -> requests allowed here since the last exchange
+        self.outgoing: Dict[int, Dict[str, int]] = {}
+        self.new_blocks: Dict[str, float] = {}
+
+    def _allowed(self, key: str, index: int):
+        counts = self.outgoing.setdefault(index, {})
+        counts[key] = counts.get(key, 0) + 1
+
+    def _block(self, key: str, until: float):
+        super()._block(key, until)
+        self.new_blocks[key] = until
+
+    def receive(self, origin: str, payload: str):
+        if origin == self.broker.origin:
+            return
+        update = orjson.loads(payload)
+        current = math.floor(time.time() / self.window)
+        for index, counts in update["hits"].items():
+            index = int(index)
+            if index < current - 1:
+                continue
+            for key, count in counts.items():
+                entry = self._entry(key, current)
+                if index == current:
+                    entry[1] += count
+                else:
+                    entry[2] += count
+        now = time.time()
+        for key, until in update["blocks"].items():
+            if until > now and until > self.blocked.get(key, 0):
+                super()._block(key, until)
+
+    async def sync(self):
+        if not self.outgoing and not self.new_blocks:
+            return
+        outgoing, self.outgoing = self.outgoing, {}
+        blocks, self.new_blocks = self.new_blocks, {}
+        await self.broker.publish(
+            [RATE_LIMIT], orjson.dumps({"hits": {str(index): counts for index, counts in outgoing.items()}, "blocks": blocks}).decode()
+        )
+
+    async def run(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.sync()
+            except Exception as e:
+                logger.error(f"Failed to share rate limit counts: {e!r}")
+
+
+def create_rate_limiter(broker_url: str, broker, **limits) -> RateLimiter:
+    if not broker_url or broker_url.startswith("memory://"):
+        return SlidingWindowLimiter(**limits)
+    return SharedSlidingWindowLimiter(broker, **limits)
+
+
+rate_limiter = create_rate_limiter(
+    settings.broker_url,
+    connection_manager.broker,
+    limit=settings.rate_limit_requests,
+    window=settings.rate_limit_window,
+    block_seconds=settings.rate_limit_block_seconds,
+    max_clients=settings.rate_limit_max_clients,
+)
+if isinstance(rate_limiter, SharedSlidingWindowLimiter):
+    connection_manager.on_control(RATE_LIMIT, rate_limiter.receive)
@@ -0,0 +1,166 @@
+"""
+Read receipts from WebSocket clients, collapsed and written in batches
+"""
+import asyncio
+import logging
+from datetime import datetime
+from typing import Collection, Dict, Optional, Tuple
+
+from sqlalchemy import bindparam, func, literal_column, or_, select, update
+
+from api.db.database import AsyncSessionLocal
+from api.models.models import DirectMessage, DMConversation, Message, ReadState
+from api.utils.read_state import unread_counter
+from api.utils.websocket_manager import connection_manager
+
+logger = logging.getLogger(__name__)
+
+read_states = ReadState.__table__
+dm_conversations = DMConversation.__table__
+
+
+def dm_partner(chat_room_id: str, user_id: int) -> Optional[int]:
+    """The other participant of a ``<min>_<max>`` DM room, if ``user_id`` is in it"""
+    try:
+        first, second = (int(part) for part in str(chat_room_id).split("_"))
+    except ValueError:
+        return None
+    if user_id == first:
+        return second
+    if user_id == second:
+        return first
+    return None
+
+
+class ReadReceipts:
+    """Keeps the highest message read per (chat, user) until the next flush.
+
+    A flush applies every receipt in one transaction and then sends one
+    ``message_read`` frame per receipt, so scrolling through a backlog
+    costs one write and one frame rather than one of each per message.
+    """
+
+    def __init__(self):
+        # ("group", group_id, user_id) or ("dm", chat_room_id, user_id) -> message id
+        self.pending: Dict[Tuple[str, object, int], int] = {}
+        self._lock = asyncio.Lock()
+
+    def record(self, chat_type: str, chat_id, user_id: int, message_id):
+        try:
+            message_id = int(message_id)
+            if chat_type == "group":
+                key = ("group", int(chat_id), user_id)
+            elif chat_type == "dm" and dm_partner(chat_id, user_id) is not None:
+                key = ("dm", str(chat_id), user_id)
+            else:
+                return
+        except (TypeError, ValueError):
+            return
+        if message_id > self.pending.get(key, 0):
+            self.pending[key] = message_id
+
+    async def flush(self):
+        async with self._lock:
+            if not self.pending:
+                return
+            pending, self.pending = self.pending, {}
+            groups = [
+                {"b_member_id": user_id, "b_group_id": chat_id, "b_message_id": message_id}
+                for (chat_type, chat_id, user_id), message_id in pending.items() if chat_type == "group"
+            ]
+            dms = [
+                {"b_user_id": user_id, "b_partner_id": dm_partner(chat_id, user_id), "b_message_id": message_id}
+                for (chat_type, chat_id, user_id), message_id in pending.items() if chat_type == "dm"
+            ]
+            try:
+                async with AsyncSessionLocal() as db:
+                    if groups:
+                        # Pending increments would otherwise land on top of the recount
+                        async with unread_counter.recounting() as excluded:
+                            await db.execute(self._group_update(excluded), groups)
+                    if dms:
+                        await db.execute(self._dm_update(), dms)
+                    await db.commit()
+            except Exception as e:
+                logger.error(f"Failed to flush read receipts: {e}")
+                for key, message_id in pending.items():
+                    if message_id > self.pending.get(key, 0):
+                        self.pending[key] = message_id
+                return
+
+        timestamp = datetime.now().isoformat()
+        await asyncio.gather(*(
+            (connection_manager.broadcast_to_group if chat_type == "group" else connection_manager.broadcast_to_dm)(
+                chat_id,
+                {
+                    "type": "message_read",
+                    "message_id": message_id,
+                    "user_id": user_id,
+                    "chat_id": chat_id,
+                    "chat_type": chat_type,
+                    "timestamp": timestamp,
+                },
+            )
+            for (chat_type, chat_id, user_id), message_id in pending.items()
+        ))
+
+    @staticmethod
+    def _group_update(excluded: Collection[int] = ()):
+        remaining = (
+            select(func.count())
+            .where(
+                Message.group_id == read_states.c.group_id,
+                Message.is_deleted == False,
+                Message.sender_id != read_states.c.member_id,
+                Message.id > bindparam("b_message_id"),
+            )
+        )
+        if excluded:
+            # Inlined, as expanding IN parameters cannot be used with executemany
+            remaining = remaining.where(Message.id.not_in([literal_column(str(int(id))) for id in excluded]))
+        remaining = remaining.scalar_subquery()
+        return (
+            update(read_states)
+            .where(
+                read_states.c.member_id == bindparam("b_member_id"),
+                read_states.c.group_id == bindparam("b_group_id"),
+                or_(
+                    read_states.c.last_read_message_id == None,
+                    read_states.c.last_read_message_id < bindparam("b_message_id"),
+                ),
+            )
+            .values(last_read_message_id=bindparam("b_message_id"), unread_count=remaining, last_read_at=datetime.now())
+        )
+
+    @staticmethod
+    def _dm_update():
+        remaining = (
+            select(func.count())
+            .where(
+                DirectMessage.sender_id == dm_conversations.c.partner_id,
+                DirectMessage.receiver_id == dm_conversations.c.user_id,
+                DirectMessage.is_deleted == False,
+                DirectMessage.id > bindparam("b_message_id"),
+            )
+            .scalar_subquery()
+        )
+        return (
+            update(dm_conversations)
+            .where(
+                dm_conversations.c.user_id == bindparam("b_user_id"),
+                dm_conversations.c.partner_id == bindparam("b_partner_id"),
+                or_(
+                    dm_conversations.c.last_read_message_id == None,
+                    dm_conversations.c.last_read_message_id < bindparam("b_message_id"),
+                ),
+            )
+            .values(last_read_message_id=bindparam("b_message_id"), unread_count=remaining)
+        )
+
+    async def run(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush()
+
+
+read_receipts = ReadReceipts()
@@ -0,0 +1,181 @@
+"""
+Per-member group read state with batched unread counters
+"""
+import asyncio
+import contextlib
+import logging
+from collections import defaultdict
+from datetime import datetime
+from typing import AsyncIterator, Collection, Dict, Optional, Set, Tuple
+
+from sqlalchemy import bindparam, case, desc, exists, func, insert, literal, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from api.db.database import AsyncSessionLocal
+from api.models.models import GroupMember, Message, ReadState
+
+logger = logging.getLogger(__name__)
+
+read_states = ReadState.__table__
+
+
+def latest_group_message_id(group_id, excluded: Collection[int] = ()):
+    stmt = select(Message.id).where(Message.group_id == group_id, Message.is_deleted == False)
+    if excluded:
+        stmt = stmt.where(Message.id.not_in(excluded))
+    return (
+        stmt
+        .order_by(desc(Message.timeSent), desc(Message.id))
+        .limit(1)
+        .correlate_except(Message)
+        .scalar_subquery()
+    )
+
+
+class UnreadCounter:
+    """Buffers new-message counts per group and applies them as batched UPDATEs.
+
+    Senders are credited back for their own messages in the same flush, so
+    a member's count only covers messages from others.
+
+    Recounts from the messages table run inside ``recounting``, which
+    flushes first and leaves out messages still being committed: those are
+    counted once their commit returns, so none is counted twice.
+    """
+
+    def __init__(self):
+        self.pending: Dict[int, int] = defaultdict(int)
+        self.own: Dict[Tuple[int, int], int] = defaultdict(int)
+        # Ids of messages whose commit is in progress
+        self.in_flight: Set[int] = set()
+        self._lock = asyncio.Lock()
+
+    def record_message(self, group_id: int, sender_id: int, count: int = 1):
+        self.pending[group_id] += count
+        self.own[(group_id, sender_id)] += count
+
+    @contextlib.asynccontextmanager
+    async def sending(self, group_id: int, sender_id: int, message_ids: Collection[int]) -> AsyncIterator[None]:
+        """Wrap the commit of new messages; they are recorded if it succeeds"""
+        self.in_flight.update(message_ids)
+        try:
+            yield
+            self.record_message(group_id, sender_id, len(message_ids))
+        finally:
+            self.in_flight.difference_update(message_ids)
+
+    @contextlib.asynccontextmanager
+    async def recounting(self) -> AsyncIterator[Set[int]]:
+        """Flush, then hold further flushes while the caller writes recounted values.
+
+        Yields the ids of messages to leave out of the recount.
+        """
+        async with self._lock:
+            excluded = set(self.in_flight)
+            await self._flush()
+            yield excluded
+
+    async def flush(self):
+        async with self._lock:
+            await self._flush()
+
+    async def _flush(self):
+        if not self.pending:
+            return
+        pending, own = self.pending, self.own
+        self.pending, self.own = defaultdict(int), defaultdict(int)
+        try:
+            async with AsyncSessionLocal() as db:
+                await db.execute(
+                    update(read_states)
+                    .where(read_states.c.group_id == bindparam("b_group_id"))
+                    .values(unread_count=read_states.c.unread_count + bindparam("b_count")),
+                    [{"b_group_id": group_id, "b_count": count} for group_id, count in pending.items()],
+                )
+                await db.execute(
+                    update(read_states)
+                    .where(
+                        read_states.c.group_id == bindparam("b_group_id"),
+                        read_states.c.member_id == bindparam("b_member_id"),
+                    )
+                    .values(unread_count=case(
+                        (read_states.c.unread_count > bindparam("b_count"), read_states.c.unread_count - bindparam("b_count")),
+                        else_=0,
+                    )),
+                    [
+                        {"b_group_id": group_id, "b_member_id": member_id, "b_count": count}
+                        for (group_id, member_id), count in own.items()
+                    ],
+                )
+                await db.commit()
+        except Exception as e:
+            logger.error(f"Failed to flush unread counters: {e}")
+            for group_id, count in pending.items():
+                self.pending[group_id] += count
+            for key, count in own.items():
+                self.own[key] += count
+
+    async def run(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush()
+
+
+unread_counter = UnreadCounter()
+
+
+async def mark_group_read(db: AsyncSession, member_id: int, group_id: int, message_id: Optional[int] = None):
+    """Move a member's read position forward and recompute what is left unread"""
+    # Pending increments would otherwise land on top of the reset
+    async with unread_counter.recounting() as excluded:
+        if message_id is None:
+            values = {"last_read_message_id": latest_group_message_id(group_id, excluded), "unread_count": 0}
+            moves_forward = True
+        else:
+            remaining = (
+                select(func.count())
+                .where(
+                    Message.group_id == group_id,
+                    Message.is_deleted == False,
+                    Message.sender_id != member_id,
+                    Message.id > message_id,
+                )
+            )
+            if excluded:
+                remaining = remaining.where(Message.id.not_in(excluded))
+            values = {"last_read_message_id": message_id, "unread_count": remaining.scalar_subquery()}
+            moves_forward = or_(ReadState.last_read_message_id == None, ReadState.last_read_message_id < message_id)
+
+        await db.execute(
+            update(ReadState)
+            .where(ReadState.member_id == member_id, ReadState.group_id == group_id, moves_forward)
+            .values(last_read_at=datetime.now(), **values)
+        )
+
+
+async def discount_deleted_message(db: AsyncSession, message: Message):
+    """Take a deleted message off the counts of members who had not read it yet"""
+    await unread_counter.flush()
+    await db.execute(
+        update(ReadState)
+        .where(
+            ReadState.group_id == message.group_id,
+            ReadState.member_id != message.sender_id,
+            ReadState.unread_count > 0,
+            or_(ReadState.last_read_message_id == None, ReadState.last_read_message_id < message.id),
+        )
+        .values(unread_count=ReadState.unread_count - 1)
+    )
+
+
+def backfill_read_states(db: Session):
+    """Create read states for memberships that predate the table"""
+    missing = select(GroupMember.member_id, GroupMember.group_id, literal(0)).where(
+        ~exists().where(
+            ReadState.member_id == GroupMember.member_id,
+            ReadState.group_id == GroupMember.group_id,
+        )
+    )
+    db.execute(insert(ReadState).from_select(["member_id", "group_id", "unread_count"], missing))
+    db.commit()
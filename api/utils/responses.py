@@ -0,0 +1,14 @@
+"""
+Default response class rendering JSON with orjson
+"""
+from typing import Any
+
+import orjson
+from fastapi.responses import JSONResponse
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered by orjson, which also encodes datetimes natively"""
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
@@ -0,0 +1,105 @@
+"""
+Per-room aggregation of typing indicators
+"""
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Dict, List, Set, Tuple
+
+import orjson
+
+logger = logging.getLogger(__name__)
+
+TYPING = "_typing"
+
+
+class TypingAggregator:
+    """Who is typing in each room, sent as at most one frame per room per tick.
+
+    Keystroke frames only refresh an entry, which expires after
+    ``timeout`` seconds without needing a stop frame. Each worker shares
+    the typers on its own sockets through the broker and sends the merged
+    list of every worker to its local sockets in the room.
+    """
+
+    def __init__(self, manager, timeout: float):
+        self.manager = manager
+        self.timeout = timeout
+        # Room channel -> user id -> (expiry, user) for this worker's sockets
+        self.local: Dict[str, Dict[int, Tuple[float, dict]]] = {}
+        # Room channel -> worker -> users typing there
+        self.typers: Dict[str, Dict[str, List[dict]]] = {}
+        self.changed: Set[str] = set()
+        self.dirty: Set[str] = set()
+
+    def update(self, channel: str, user, is_typing: bool):
+        room = self.local.setdefault(channel, {})
+        if is_typing:
+            if user.id not in room:
+                self.changed.add(channel)
+            room[user.id] = (
+                time.monotonic() + self.timeout,
+                {"id": user.id, "username": user.username, "nickname": user.nickname},
+            )
+        elif room.pop(user.id, None) is not None:
+            self.changed.add(channel)
+        if not room:
+            del self.local[channel]
+
+    def receive(self, origin: str, payload: str):
+        update = orjson.loads(payload)
+        room = self.typers.setdefault(update["channel"], {})
+        if update["users"]:
+            room[origin] = update["users"]
+        else:
+            room.pop(origin, None)
+            if not room:
+                del self.typers[update["channel"]]
+        self.dirty.add(update["channel"])
+
+    def forget(self, origin: str):
+        for channel in list(self.typers):
+            if self.typers[channel].pop(origin, None) is not None:
+                self.dirty.add(channel)
+                if not self.typers[channel]:
+                    del self.typers[channel]
+
+    async def tick(self):
+        now = time.monotonic()
+        for channel in list(self.local):
+            room = self.local[channel]
+            for user_id in [user_id for user_id, (expires, _) in room.items() if expires <= now]:
+                del room[user_id]
+                self.changed.add(channel)
+            if not room:
+                del self.local[channel]
+
+        changed, self.changed = self.changed, set()
+        for channel in changed:
+            users = [user for _, user in self.local.get(channel, {}).values()]
+            await self.manager.broker.publish(
+                [TYPING], orjson.dumps({"channel": channel, "users": users}).decode()
+            )
+
+        dirty, self.dirty = self.dirty, set()
+        timestamp = datetime.now().isoformat()
+        for channel in dirty:
+            kind, _, key = channel.partition(":")
+            frame = {
+                "type": "typing_users",
+                "chat_type": kind,
+                "chat_id": int(key) if kind == "group" else key,
+                "users": [user for users in self.typers.get(channel, {}).values() for user in users],
+                "timestamp": timestamp,
+            }
+            # Every worker sends the merged list to its own sockets
+            await self.manager.deliver(self.manager.broker.origin, [channel], orjson.dumps(frame).decode())
+
+    async def run(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.tick()
+            except Exception as e:
+                logger.error(f"Failed to send typing indicators: {e!r}")
@@ -0,0 +1,87 @@
+"""
+Cache of authenticated users so most requests resolve without a query
+"""
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import make_transient_to_detached
+
+from api.config.settings import settings
+from api.models.models import User
+from api.utils.websocket_manager import connection_manager
+
+USER_CHANGED = "_user_changed"
+
+_columns = [attr.key for attr in User.__mapper__.column_attrs]
+
+
+class UserCache:
+    """Bounded LRU of user rows, each entry kept for at most ``ttl`` seconds.
+
+    Presence columns (is_online, status, last_seen) are written behind the
+    ORM and may be up to ``ttl`` old in a cached entry; everything a user
+    edits is invalidated explicitly.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: "OrderedDict[int, Tuple[float, dict]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Bumped on every invalidation, so a lookup that raced one isn't stored
+        self.generation = 0
+
+    def get(self, user_id: int) -> Optional[dict]:
+        entry = self.entries.get(user_id)
+        if entry is None or entry[0] <= time.monotonic():
+            if entry is not None:
+                del self.entries[user_id]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(user_id)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, user: User, generation: int):
+        if generation != self.generation:
+            return
+        self.entries[user.id] = (time.monotonic() + self.ttl, {key: getattr(user, key) for key in _columns})
+        self.entries.move_to_end(user.id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        self.generation += 1
+        self.entries.pop(user_id, None)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+user_cache = UserCache(settings.user_cache_size, settings.user_cache_ttl)
+connection_manager.on_control(USER_CHANGED, lambda origin, payload: user_cache.invalidate(int(payload)))
+
+
+async def cached_user(db: AsyncSession, user_id: int) -> Optional[User]:
+    """A cached user attached to ``db`` without a SELECT, so edits still persist"""
+    values = user_cache.get(user_id)
+    if values is None:
+        return None
+    user = User(**values)
+    make_transient_to_detached(user)
+    return await db.merge(user, load=False)
+
+
+async def invalidate_user(user_id: int):
+    """Drop a changed user from the cache of every worker"""
+    await connection_manager.broker.publish([USER_CHANGED], str(user_id))
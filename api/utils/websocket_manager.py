@@ -1,167 +1,404 @@
-from typing import Dict, List, Set
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
 from fastapi import WebSocket
+import asyncio
 import json
 import logging
+import math
+import time
 from datetime import datetime
 
+import orjson
+
+from api.config.settings import settings
+from api.utils.broker import BYE, HELLO, create_broker
+from api.utils.typing_indicator import TYPING, TypingAggregator
+
 logger = logging.getLogger(__name__)
 
 
+def _percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    # Nearest-rank percentile
+    index = min(len(sorted_values) - 1, max(0, math.ceil(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def encode_message(message: dict) -> str:
+    # Text frames, so browser clients can keep using JSON.parse
+    return orjson.dumps(message).decode()
+
+
+# Closes of sockets that failed a send, kept so they are not garbage collected
+_closing: Set[asyncio.Task] = set()
+
+
+async def _close(websocket: WebSocket):
+    try:
+        # 1013: try again later
+        await asyncio.wait_for(websocket.close(code=1013), timeout=settings.ws_send_timeout)
+    except Exception:
+        pass
+
+
+async def _timed_send(websocket: WebSocket, payload: str, started: float):
+    try:
+        await asyncio.wait_for(websocket.send_text(payload), timeout=settings.ws_send_timeout)
+    except Exception as e:
+        logger.error(f"Error sending to websocket: {e!r}")
+        # The frame may be cut off mid-send and the socket is dropped from its
+        # rooms; closing it makes the client reconnect instead of going quiet
+        task = asyncio.create_task(_close(websocket))
+        _closing.add(task)
+        task.add_done_callback(_closing.discard)
+        return None
+    return time.perf_counter() - started
+
+
+async def fan_out(websockets: Iterable[WebSocket], message: dict, label: str = "broadcast") -> Tuple[List[WebSocket], dict]:
+    """Send a message to every socket concurrently.
+
+    The payload is encoded once and the same frame goes to every recipient.
+    A slow or dead socket only delays itself, up to ws_send_timeout, and is
+    then closed so its client reconnects. Returns
+    the sockets that failed and the p50/p99 delivery time of this fan-out.
+    """
+    return await fan_out_encoded(websockets, encode_message(message), label)
+
+
+async def fan_out_encoded(websockets: Iterable[WebSocket], payload: str, label: str = "broadcast") -> Tuple[List[WebSocket], dict]:
+    targets = list(websockets)
+    if not targets:
+        return [], {"recipients": 0, "failed": 0, "p50_ms": 0.0, "p99_ms": 0.0, "duration_ms": 0.0}
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(_timed_send(ws, payload, started) for ws in targets))
+    duration = time.perf_counter() - started
+
+    failed = [ws for ws, elapsed in zip(targets, results) if elapsed is None]
+    latencies = sorted(elapsed for elapsed in results if elapsed is not None)
+    stats = {
+        "recipients": len(targets),
+        "failed": len(failed),
+        "p50_ms": round(_percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(_percentile(latencies, 99) * 1000, 3),
+        "duration_ms": round(duration * 1000, 3),
+    }
+    logger.debug(f"Fan-out {label}: {stats}")
+    return failed, stats
+
+
+def _discard(connections: Dict, key, websockets: List[WebSocket]):
+    if key not in connections:
+        return
+    for ws in websockets:
+        if ws in connections[key]:
+            connections[key].remove(ws)
+
+
 class ConnectionManager:
+    """Tracks this worker's sockets and routes every broadcast through the broker.
+
+    Broadcasts are published on channels named ``<kind>:<key>``; each worker
+    fans a frame out to the local sockets registered under that channel, so
+    rooms span all workers attached to the same broker.
+    """
+
     def __init__(self):
         self.group_connections: Dict[int, List[WebSocket]] = {}
         self.dm_connections: Dict[str, List[WebSocket]] = {}
         self.user_connections: Dict[int, List[WebSocket]] = {}
+        # Sockets of the plain /chat/{chatid} and /dm/chat/{user_id} endpoints
+        self.chat_connections: Dict[int, List[WebSocket]] = {}
+        self.dm_chat_connections: Dict[str, List[WebSocket]] = {}
         self.online_users: Set[int] = set()
         self.user_websocket_map: Dict[int, WebSocket] = {}
+        # Users online on other workers, with the workers holding them
+        self.remote_online: Dict[int, Set[str]] = {}
+        # Local users -> whose presence they see, and the reverse index
+        self.presence_scopes: Dict[int, Set[int]] = {}
+        self.watchers: Dict[int, Set[int]] = {}
+        # Local presence changes waiting for the next batched diff
+        self.presence_changes: Dict[int, bool] = {}
+        self.typing = TypingAggregator(self, settings.typing_timeout)
+        # Extra handlers of control channels, called with (origin, payload)
+        self.control_handlers: Dict[str, List[Callable[[str, str], None]]] = {}
+        self._tasks: List[asyncio.Task] = []
+        self.rooms = {
+            "group": (self.group_connections, int),
+            "dm": (self.dm_connections, str),
+            "user": (self.user_connections, int),
+            "chat": (self.chat_connections, int),
+            "dmchat": (self.dm_chat_connections, str),
+        }
+        self.broker = create_broker(settings.broker_url, self.deliver)
 
-    async def connect_user(self, websocket: WebSocket, user_id: int):
-        if user_id not in self.user_connections:
-            self.user_connections[user_id] = []
-        self.user_connections[user_id].append(websocket)
-        
+    async def start(self):
+        await self.broker.start()
+        self._tasks = [
+            asyncio.create_task(self._run_presence(settings.presence_batch_interval)),
+            asyncio.create_task(self.typing.run(settings.typing_interval)),
+        ]
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        await self.flush_presence()
+        await self.broker.close()
+
+    def on_control(self, channel: str, handler: Callable[[str, str], None]):
+        self.control_handlers.setdefault(channel, []).append(handler)
+
+    async def publish(self, message: dict, *channels: str) -> dict:
+        return await self.broker.publish(list(channels), encode_message(message))
+
+    async def deliver(self, origin: str, channels: List[str], payload: str) -> dict:
+        """Fan a published frame out to this worker's sockets"""
+        if channels[0].startswith("_"):
+            await self._handle_control(origin, channels[0], payload)
+            return {}
+        if channels[0] == "presence":
+            return await self._deliver_presence(origin, orjson.loads(payload))
+
+        targets = []
+        for channel in channels:
+            kind, _, key = channel.partition(":")
+            connections, key_type = self.rooms[kind]
+            key = key_type(key)
+            targets.extend((connections, key, websocket) for websocket in connections.get(key, []))
+
+        # A socket can be registered under several keys, send it the frame once
+        websockets = dict.fromkeys(ws for _, _, ws in targets)
+        failed, stats = await fan_out_encoded(websockets, payload, ",".join(channels))
+        failed = set(failed)
+        for connections, key, websocket in targets:
+            if websocket in failed:
+                _discard(connections, key, [websocket])
+        return stats
+
+    async def _handle_control(self, origin: str, channel: str, payload: str):
+        if channel == HELLO:
+            if origin == self.broker.origin:
+                # (Re)joined the broker, peers will resend what they hold
+                self.remote_online.clear()
+            await self.broker.publish(["_presence"], encode_message({"users": sorted(self.online_users)}))
+        elif channel == BYE:
+            self._forget_worker(origin)
+            self.typing.forget(origin)
+        elif channel == TYPING:
+            self.typing.receive(origin, payload)
+        elif channel == "_presence" and origin != self.broker.origin:
+            self._forget_worker(origin)
+            for user_id in orjson.loads(payload)["users"]:
+                self._track_remote(user_id, origin, True)
+        for handler in self.control_handlers.get(channel, ()):
+            handler(origin, payload)
+
+    def _track_remote(self, user_id: int, origin: str, is_online: bool):
+        if is_online:
+            self.remote_online.setdefault(user_id, set()).add(origin)
+        elif user_id in self.remote_online:
+            self.remote_online[user_id].discard(origin)
+            if not self.remote_online[user_id]:
+                del self.remote_online[user_id]
+
+    def _forget_worker(self, origin: str):
+        for user_id in list(self.remote_online):
+            self._track_remote(user_id, origin, False)
+
+    def _watch(self, user_id: int, scope: Iterable[int]):
+        self._unwatch(user_id)
+        self.presence_scopes[user_id] = set(scope)
+        for watched_id in self.presence_scopes[user_id]:
+            self.watchers.setdefault(watched_id, set()).add(user_id)
+
+    def _unwatch(self, user_id: int):
+        for watched_id in self.presence_scopes.pop(user_id, ()):
+            watchers = self.watchers.get(watched_id)
+            if watchers is not None:
+                watchers.discard(user_id)
+                if not watchers:
+                    del self.watchers[watched_id]
+
+    def record_presence(self, user_id: int, is_online: bool):
+        # Within one window only the latest state of a user is sent
+        self.presence_changes[user_id] = is_online
+
+    async def flush_presence(self):
+        if not self.presence_changes:
+            return
+        changes, self.presence_changes = self.presence_changes, {}
+        await self.broker.publish(["presence"], encode_message({
+            "online": [user_id for user_id, is_online in changes.items() if is_online],
+            "offline": [user_id for user_id, is_online in changes.items() if not is_online],
+        }))
+
+    async def _run_presence(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush_presence()
+            except Exception as e:
+                logger.error(f"Failed to publish presence changes: {e!r}")
+
+    async def _deliver_presence(self, origin: str, diff: dict) -> dict:
+        """Send each local watcher one frame with the changes it is allowed to see"""
+        if origin != self.broker.origin:
+            for user_id in diff["online"]:
+                self._track_remote(user_id, origin, True)
+            for user_id in diff["offline"]:
+                self._track_remote(user_id, origin, False)
+
+        per_watcher: Dict[int, Tuple[List[int], List[int]]] = {}
+        for user_id in diff["online"]:
+            for watcher_id in self.watchers.get(user_id, ()):
+                per_watcher.setdefault(watcher_id, ([], []))[0].append(user_id)
+        for user_id in diff["offline"]:
+            # Still connected through another worker or socket
+            if self.is_user_online(user_id):
+                continue
+            for watcher_id in self.watchers.get(user_id, ()):
+                per_watcher.setdefault(watcher_id, ([], []))[1].append(user_id)
+
+        timestamp = datetime.now().isoformat()
+        results = await asyncio.gather(*(
+            self._send_local(watcher_id, {
+                "type": "presence_diff",
+                "online": online,
+                "offline": offline,
+                "timestamp": timestamp,
+            })
+            for watcher_id, (online, offline) in per_watcher.items()
+        ))
+        return {
+            "recipients": sum(stats["recipients"] for stats in results),
+            "failed": sum(stats["failed"] for stats in results),
+        }
+
+    async def _send_local(self, user_id: int, message: dict) -> dict:
+        failed, stats = await fan_out(list(dict.fromkeys(self.user_connections.get(user_id, []))), message, f"user {user_id}")
+        _discard(self.user_connections, user_id, failed)
+        return stats
+
+    def _add_socket(self, websocket: WebSocket, user_id: int) -> bool:
+        """Register one of a user's sockets; True when it is their first one here"""
+        self.user_connections.setdefault(user_id, []).append(websocket)
+        if user_id in self.online_users:
+            return False
         self.online_users.add(user_id)
+        self.record_presence(user_id, True)
+        return True
+
+    def _remove_socket(self, websocket: WebSocket, user_id: int, closed: bool = False) -> bool:
+        """Unregister one of a user's sockets; True when it was their last one here.
+
+        A socket is listed once per room it joined; ``closed`` drops every entry.
+        """
+        connections = self.user_connections.get(user_id)
+        while connections is not None and websocket in connections:
+            connections.remove(websocket)
+            if not closed:
+                break
+        # A failed send may already have discarded the socket
+        if connections or user_id not in self.online_users:
+            return False
+        self.user_connections.pop(user_id, None)
+        self.online_users.discard(user_id)
+        self.user_websocket_map.pop(user_id, None)
+        self._unwatch(user_id)
+        self.record_presence(user_id, False)
+        return True
+
+    async def connect_user(self, websocket: WebSocket, user_id: int, scope: Iterable[int] = ()) -> bool:
+        """Register a user's socket; ``scope`` is who they see the presence of"""
+        first = self._add_socket(websocket, user_id)
         self.user_websocket_map[user_id] = websocket
+        self._watch(user_id, scope)
         
-        await self.broadcast_user_status(user_id, True)
         logger.info(f"User {user_id} connected and marked online")
+        return first
 
-    async def connect_to_group(self, websocket: WebSocket, group_id: int, user_id: int):
+    async def connect_to_group(self, websocket: WebSocket, group_id: int, user_id: int) -> bool:
         if group_id not in self.group_connections:
             self.group_connections[group_id] = []
-        
-        if user_id not in self.user_connections:
-            self.user_connections[user_id] = []
             
         self.group_connections[group_id].append(websocket)
-        self.user_connections[user_id].append(websocket)
-        self.online_users.add(user_id)
+        first = self._add_socket(websocket, user_id)
         
         logger.info(f"User {user_id} connected to group {group_id}")
+        return first
 
-    async def connect_to_dm(self, websocket: WebSocket, chat_room_id: str, user_id: int):
+    async def connect_to_dm(self, websocket: WebSocket, chat_room_id: str, user_id: int) -> bool:
         if chat_room_id not in self.dm_connections:
             self.dm_connections[chat_room_id] = []
             
-        if user_id not in self.user_connections:
-            self.user_connections[user_id] = []
-            
         self.dm_connections[chat_room_id].append(websocket)
-        self.user_connections[user_id].append(websocket)
-        self.online_users.add(user_id)
+        first = self._add_socket(websocket, user_id)
         
         logger.info(f"User {user_id} connected to DM room {chat_room_id}")
+        return first
 
-    async def disconnect_user(self, websocket: WebSocket, user_id: int):
-        if user_id in self.user_connections:
-            if websocket in self.user_connections[user_id]:
-                self.user_connections[user_id].remove(websocket)
-            if not self.user_connections[user_id]:
-                del self.user_connections[user_id]
-                self.online_users.discard(user_id)
-                if user_id in self.user_websocket_map:
-                    del self.user_websocket_map[user_id]
-                await self.broadcast_user_status(user_id, False)
+    async def disconnect_user(self, websocket: WebSocket, user_id: int) -> bool:
+        """Returns True when this was the user's last socket on this worker"""
+        last = self._remove_socket(websocket, user_id, closed=True)
         
         logger.info(f"User {user_id} disconnected and marked offline")
+        return last
 
-    def disconnect_from_group(self, websocket: WebSocket, group_id: int, user_id: int):
+    def disconnect_from_group(self, websocket: WebSocket, group_id: int, user_id: int) -> bool:
         if group_id in self.group_connections:
             if websocket in self.group_connections[group_id]:
                 self.group_connections[group_id].remove(websocket)
                 
-        if user_id in self.user_connections:
-            if websocket in self.user_connections[user_id]:
-                self.user_connections[user_id].remove(websocket)
-            if not self.user_connections[user_id]:
-                self.online_users.discard(user_id)
+        last = self._remove_socket(websocket, user_id)
                 
         logger.info(f"User {user_id} disconnected from group {group_id}")
+        return last
 
-    def disconnect_from_dm(self, websocket: WebSocket, chat_room_id: str, user_id: int):
+    def disconnect_from_dm(self, websocket: WebSocket, chat_room_id: str, user_id: int) -> bool:
         if chat_room_id in self.dm_connections:
             if websocket in self.dm_connections[chat_room_id]:
                 self.dm_connections[chat_room_id].remove(websocket)
                 
-        if user_id in self.user_connections:
-            if websocket in self.user_connections[user_id]:
-                self.user_connections[user_id].remove(websocket)
-            if not self.user_connections[user_id]:
-                self.online_users.discard(user_id)
+        last = self._remove_socket(websocket, user_id)
                 
         logger.info(f"User {user_id} disconnected from DM room {chat_room_id}")
+        return last
 
-    async def broadcast_to_group(self, group_id: int, message: dict):
-        if group_id not in self.group_connections:
-            return
-            
-        disconnected = []
-        for websocket in self.group_connections[group_id]:
-            try:
-                await websocket.send_json(message)
-            except Exception as e:
-                logger.error(f"Error broadcasting to group {group_id}: {e}")
-                disconnected.append(websocket)
-        
-        for ws in disconnected:
-            self.group_connections[group_id].remove(ws)
+    async def broadcast_to_group(self, group_id: int, message: dict) -> dict:
+        return await self.publish(message, f"group:{group_id}")
 
-    async def broadcast_to_dm(self, chat_room_id: str, message: dict):
-        if chat_room_id not in self.dm_connections:
-            return
-            
-        disconnected = []
-        for websocket in self.dm_connections[chat_room_id]:
-            try:
-                await websocket.send_json(message)
-            except Exception as e:
-                logger.error(f"Error broadcasting to DM {chat_room_id}: {e}")
-                disconnected.append(websocket)
-        
-        for ws in disconnected:
-            self.dm_connections[chat_room_id].remove(ws)
+    async def broadcast_to_dm(self, chat_room_id: str, message: dict) -> dict:
+        return await self.publish(message, f"dm:{chat_room_id}")
 
-    async def send_to_user(self, user_id: int, message: dict):
-        if user_id not in self.user_connections:
-            return
-            
-        disconnected = []
-        for websocket in self.user_connections[user_id]:
-            try:
-                await websocket.send_json(message)
-            except Exception as e:
-                logger.error(f"Error sending to user {user_id}: {e}")
-                disconnected.append(websocket)
-        
-        for ws in disconnected:
-            self.user_connections[user_id].remove(ws)
+    async def broadcast_to_chat(self, chat_id: int, message: dict) -> dict:
+        return await self.publish(message, f"chat:{chat_id}")
+
+    async def broadcast_to_dm_chat(self, chat_room_id: str, message: dict) -> dict:
+        return await self.publish(message, f"dmchat:{chat_room_id}")
+
+    async def broadcast_group_event(self, group_id: int, message: dict) -> dict:
+        """Reach both the chat and the group sockets of a group with one frame"""
+        return await self.publish(message, f"chat:{group_id}", f"group:{group_id}")
 
-    def get_online_users(self) -> List[int]:
-        return [user_id for user_id, connections in self.user_connections.items() if connections]
+    async def broadcast_dm_event(self, chat_room_id: str, message: dict) -> dict:
+        """Reach both the chat and the DM sockets of a conversation with one frame"""
+        return await self.publish(message, f"dmchat:{chat_room_id}", f"dm:{chat_room_id}")
+
+    async def send_to_user(self, user_id: int, message: dict) -> dict:
+        return await self.publish(message, f"user:{user_id}")
+
+    def get_online_users(self, among: Optional[Iterable[int]] = None) -> List[int]:
+        if among is not None:
+            return [user_id for user_id in among if self.is_user_online(user_id)]
+        local = [user_id for user_id, connections in self.user_connections.items() if connections]
+        return local + [user_id for user_id in self.remote_online if user_id not in self.user_connections]
 
     def is_user_online(self, user_id: int) -> bool:
-        return user_id in self.online_users
-
-    async def broadcast_user_status(self, user_id: int, is_online: bool):
-        status_message = {
-            "type": "user_status",
-            "user_id": user_id,
-            "is_online": is_online,
-            "timestamp": datetime.now().isoformat()
-        }
-        
-        disconnected = []
-        for connected_user_id, websockets in self.user_connections.items():
-            if connected_user_id != user_id:
-                for websocket in websockets:
-                    try:
-                        await websocket.send_json(status_message)
-                    except Exception as e:
-                        logger.error(f"Error broadcasting status to user {connected_user_id}: {e}")
-                        disconnected.append((connected_user_id, websocket))
-        
-        for user_id_disc, ws in disconnected:
-            if user_id_disc in self.user_connections and ws in self.user_connections[user_id_disc]:
-                self.user_connections[user_id_disc].remove(ws)
+        return user_id in self.online_users or user_id in self.remote_online
 
-connection_manager = ConnectionManager()
\ No newline at end of file
+connection_manager = ConnectionManager()
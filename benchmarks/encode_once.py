@@ -0,0 +1,83 @@
+"""
+CPU spent on one broadcast, encoding the message for every recipient
+versus once per fan-out: serialization alone, then the whole fan-out
+
+    python -m benchmarks.encode_once
+"""
+import asyncio
+import json
+import time
+
+from api.utils.websocket_manager import encode_message, fan_out
+
+SIZES = (10, 100, 1000, 5000)
+MESSAGE = {
+    "type": "new_message",
+    "group_id": 123456789012,
+    "message": {
+        "id": 987654321012345,
+        "content": "hello there " * 8,
+        "sender": {"id": 1, "username": "alice", "nickname": "Alice", "avatar": None},
+        "timeSent": "2026-10-17T10:00:00.123456",
+        "reply_to": {"id": 1, "content": "earlier", "sender": "bobby"},
+    },
+}
+
+
+class Socket:
+    async def send_json(self, message: dict):
+        # What Starlette's send_json does before writing the frame
+        json.dumps(message, separators=(",", ":"), ensure_ascii=False)
+
+    async def send_text(self, payload: str):
+        pass
+
+
+async def per_socket(sockets, message: dict):
+    """What every broadcast did before: send_json on each socket"""
+    await asyncio.gather(*(websocket.send_json(message) for websocket in sockets))
+
+
+async def encode_once(sockets, message: dict):
+    await fan_out(sockets, message)
+
+
+async def cpu_ms(broadcast, sockets, repeat: int) -> float:
+    started = time.process_time()
+    for _ in range(repeat):
+        await broadcast(sockets, MESSAGE)
+    return (time.process_time() - started) / repeat * 1000
+
+
+def serialize_ms(encode, size: int, repeat: int = 50) -> float:
+    started = time.process_time()
+    for _ in range(repeat):
+        encode(size)
+    return (time.process_time() - started) / repeat * 1000
+
+
+def encode_each(size: int):
+    for _ in range(size):
+        json.dumps(MESSAGE, separators=(",", ":"), ensure_ascii=False)
+
+
+async def main():
+    print("Serialization CPU per broadcast")
+    print(f"{'recipients':>10} {'per socket':>12} {'encode once':>12}")
+    for size in SIZES:
+        before = serialize_ms(encode_each, size)
+        after = serialize_ms(lambda size: encode_message(MESSAGE), size)
+        print(f"{size:>10} {before:>9.3f} ms {after:>9.3f} ms")
+
+    print("\nCPU per broadcast, serialization and fan-out included")
+    print(f"{'recipients':>10} {'per socket':>12} {'encode once':>12}")
+    for size in SIZES:
+        sockets = [Socket() for _ in range(size)]
+        repeat = max(20, 20000 // size)
+        before = await cpu_ms(per_socket, sockets, repeat)
+        after = await cpu_ms(encode_once, sockets, repeat)
+        print(f"{size:>10} {before:>9.3f} ms {after:>9.3f} ms")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
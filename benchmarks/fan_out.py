@@ -0,0 +1,60 @@
+"""
+Fan-out of one frame to a room with a stalled client, one socket after
+another versus concurrently through fan_out
+
+    python -m benchmarks.fan_out
+
+Sockets are fakes taking 0.2 ms per send; the stalled one never finishes
+and is cut off at ws_send_timeout, which the one-by-one loop is given too.
+"""
+import asyncio
+import logging
+import time
+
+from api.config.settings import settings
+from api.utils.websocket_manager import encode_message, fan_out
+
+SEND_SECONDS = 0.0002
+SIZES = (100, 1000, 5000)
+
+
+class Socket:
+    def __init__(self, delay: float):
+        self.delay = delay
+
+    async def send_text(self, payload: str):
+        await asyncio.sleep(self.delay)
+
+    async def close(self, code: int = 1000):
+        pass
+
+
+async def one_by_one(sockets, message: dict) -> float:
+    """What every broadcast did before: await each send in turn"""
+    started = time.perf_counter()
+    for websocket in sockets:
+        try:
+            await asyncio.wait_for(websocket.send_text(encode_message(message)), timeout=settings.ws_send_timeout)
+        except Exception:
+            pass
+    return time.perf_counter() - started
+
+
+async def main():
+    logging.getLogger("api.utils.websocket_manager").setLevel(logging.CRITICAL)
+    settings.ws_send_timeout = 0.5
+    message = {"type": "new_message", "content": "hello"}
+    print(f"ws_send_timeout {settings.ws_send_timeout} s, stalled client first in the room")
+    print(f"{'sockets':>8} {'one by one':>12} {'fan_out':>10} {'p50':>9} {'p99':>9} {'failed':>7}")
+    for size in SIZES:
+        sockets = [Socket(3600)] + [Socket(SEND_SECONDS) for _ in range(size - 1)]
+        serial = await one_by_one(sockets, message)
+        failed, stats = await fan_out(sockets, message)
+        print(
+            f"{size:>8} {serial * 1000:>9.0f} ms {stats['duration_ms']:>7.0f} ms "
+            f"{stats['p50_ms']:>6.1f} ms {stats['p99_ms']:>6.1f} ms {len(failed):>7}"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,99 @@
+"""
+WebSocket fan-out latency during a storm of logins, with bcrypt run inline
+on the event loop versus on the bounded password hashing pool
+
+    python -m benchmarks.login_storm [--logins 24] [--rounds 12]
+
+A probe fans a frame out to 200 sockets every 10 ms while the logins run;
+its latency counts from when the tick was due, so a blocked loop shows.
+The app runs against a scratch SQLite file.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+import time
+
+DATABASE = os.path.join(tempfile.mkdtemp(prefix="login-storm-"), "bench.db")
+# Settings are read when api is first imported
+os.environ.update(
+    DATABASE_URL=f"sqlite:///{DATABASE}",
+    BROKER_URL="",
+    BCRYPT_TARGET_MS="0",
+    RATE_LIMIT_REQUESTS="1000000",
+)
+
+import httpx  # noqa: E402
+
+from api.app import app  # noqa: E402
+from api.config.settings import settings  # noqa: E402
+from api.utils.password_hashing import password_hasher  # noqa: E402
+from api.utils.websocket_manager import fan_out  # noqa: E402
+
+SOCKETS = 200
+INTERVAL = 0.01
+CREDENTIALS = {"username": "storm", "password": "Passw0rd!"}
+
+
+class Socket:
+    async def send_text(self, payload: str):
+        await asyncio.sleep(0)
+
+
+async def probe(stop: asyncio.Event, samples: list):
+    sockets = [Socket() for _ in range(SOCKETS)]
+    due = time.perf_counter()
+    while not stop.is_set():
+        await fan_out(sockets, {"type": "new_message", "content": "probe"})
+        samples.append((time.perf_counter() - due) * 1000)
+        due += INTERVAL
+        await asyncio.sleep(max(0.0, due - time.perf_counter()))
+        due = max(due, time.perf_counter())
+
+
+async def storm(client: httpx.AsyncClient, label: str, logins: int):
+    stop, samples = asyncio.Event(), []
+    task = asyncio.create_task(probe(stop, samples))
+    await asyncio.sleep(0.2)
+    started = time.perf_counter()
+    responses = await asyncio.gather(*(client.post("/auth/login", data=CREDENTIALS) for _ in range(logins)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await task
+
+    samples.sort()
+    codes = sorted({response.status_code for response in responses})
+    print(
+        f"{label:>9}: {logins} logins in {elapsed:.2f} s, status {codes}; fan-out to {SOCKETS} sockets "
+        f"p50 {samples[len(samples) // 2]:.1f} ms, p99 {samples[int(len(samples) * 0.99) - 1]:.1f} ms, "
+        f"max {samples[-1]:.0f} ms over {len(samples)} probes"
+    )
+
+
+async def main(args):
+    settings.bcrypt_rounds = password_hasher.rounds = args.rounds
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            response = await client.post("/auth/register", json={
+                "email": "storm@example.com", "nickname": "Storm", **CREDENTIALS,
+            })
+            response.raise_for_status()
+
+            async def inline(fn, *args):
+                return fn(*args)
+
+            # What login did before: bcrypt straight on the event loop
+            password_hasher._run = inline
+            await storm(client, "inline", args.logins)
+            del password_hasher._run
+            await storm(client, "pool", args.logins)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fan-out latency during a login storm")
+    parser.add_argument("--logins", type=int, default=24)
+    parser.add_argument("--rounds", type=int, default=12, help="bcrypt cost")
+    logging.disable(logging.WARNING)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,84 @@
+"""
+Per-request overhead of the security middleware on a trivial route, called
+directly over ASGI
+
+    python -m benchmarks.middleware
+
+The previous stack was three BaseHTTPMiddleware classes; it is stood in for
+by three pass-through BaseHTTPMiddleware layers, which is the cost it paid
+before doing any work of its own.
+"""
+import asyncio
+import time
+
+from fastapi import FastAPI
+from starlette.middleware.base import BaseHTTPMiddleware
+
+from api.middleware.security import SecurityMiddleware
+from api.utils.rate_limit import SlidingWindowLimiter
+
+REQUESTS = 3000
+RUNS = 5
+
+
+class PassThrough(BaseHTTPMiddleware):
+    async def dispatch(self, request, call_next):
+        return await call_next(request)
+
+
+def make_app(stack: str) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/dm/{x}")
+    async def route(x: int):
+        return {"x": x}
+
+    if stack == "BaseHTTPMiddleware x3":
+        for _ in range(3):
+            app.add_middleware(PassThrough)
+    elif stack == "SecurityMiddleware":
+        limiter = SlidingWindowLimiter(10 ** 9, 60, block_seconds=60, max_clients=1000)
+        app.add_middleware(SecurityMiddleware, limiter=limiter)
+    return app
+
+
+async def call(app: FastAPI):
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+        "scheme": "http", "path": "/dm/1", "raw_path": b"/dm/1", "root_path": "", "query_string": b"",
+        "headers": [(b"host", b"bench"), (b"authorization", b"Bearer token")],
+        "client": ("203.0.113.9", 50000), "server": ("bench", 80),
+    }
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    await app(scope, receive, send)
+
+
+async def per_request_us(app: FastAPI) -> float:
+    for _ in range(500):
+        await call(app)
+    best = float("inf")
+    for _ in range(RUNS):
+        started = time.perf_counter()
+        for _ in range(REQUESTS):
+            await call(app)
+        best = min(best, (time.perf_counter() - started) / REQUESTS)
+    return best * 1e6
+
+
+async def main():
+    print(f"best of {RUNS} runs of {REQUESTS} requests")
+    baseline = None
+    for stack in ("none", "BaseHTTPMiddleware x3", "SecurityMiddleware"):
+        cost = await per_request_us(make_app(stack))
+        baseline = cost if baseline is None else baseline
+        print(f"{stack:>22}: {cost:6.1f} us per request ({cost - baseline:+.1f} us)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,96 @@
+"""
+Serialization cost of one page of messages or friends, through
+jsonable_encoder and json.dumps versus the response models and orjson
+
+    python -m benchmarks.response_models
+
+Both paths are checked to put the same JSON on the wire.
+"""
+import json
+import time
+from datetime import datetime, timedelta
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from pydantic import TypeAdapter
+
+from api.schema.schema import DirectMessagePage, FriendsListResponse, GroupMessagePage
+from api.utils.responses import FastJSONResponse
+
+REPEAT = 2000
+RUNS = 5
+
+NOW = datetime.now()
+AUTHOR = {"id": 361037248721280, "username": "alice", "nickname": "Alice", "avatar": "https://i.ibb.co/DpZXbnN/user-3296.png"}
+REPLY = {
+    "id": 361037250220416,
+    "content": {"content": "earlier message"},
+    "sender": {key: AUTHOR[key] for key in ("id", "username", "nickname")},
+}
+
+
+def group_page(size: int = 25) -> dict:
+    return {"messages": [{
+        "id": 361037250220416 + i,
+        "channelId": 361037248975232,
+        "content": {"content": f"message {i} " * 5},
+        "timeSent": NOW - timedelta(seconds=i),
+        "is_edited": i % 5 == 0,
+        "edited_at": NOW if i % 5 == 0 else None,
+        "reply_to": REPLY if i % 3 == 0 else None,
+        "user": AUTHOR,
+    } for i in range(size)], "next_cursor": 361037250220000}
+
+
+def dm_page(size: int = 50) -> dict:
+    return {"messages": [{
+        "id": 361037250220416 + i,
+        "content": {"content": f"dm {i} " * 5},
+        "timeSent": NOW - timedelta(seconds=i),
+        "is_edited": False,
+        "edited_at": None,
+        "reply_to": REPLY if i % 4 == 0 else None,
+        "sender": AUTHOR,
+        "receiver_id": 361037248795008,
+    } for i in range(size)], "next_cursor": None}
+
+
+def friends_list(size: int = 100) -> dict:
+    return {"friends": [
+        {"id": i, "friend": {**AUTHOR, "status": 1}, "nickname": None, "notes": "n", "since": NOW}
+        for i in range(size)
+    ]}
+
+
+def per_call_us(render) -> float:
+    best = float("inf")
+    for _ in range(RUNS):
+        started = time.perf_counter()
+        for _ in range(REPEAT):
+            render()
+        best = min(best, (time.perf_counter() - started) / REPEAT)
+    return best * 1e6
+
+
+def main():
+    print(f"best of {RUNS} runs of {REPEAT}")
+    for label, model, make in (
+        ("group page of 25", GroupMessagePage, group_page),
+        ("DM page of 50", DirectMessagePage, dm_page),
+        ("friends list of 100", FriendsListResponse, friends_list),
+    ):
+        data, adapter = make(), TypeAdapter(model)
+
+        def before():
+            return JSONResponse(jsonable_encoder(data)).body
+
+        def after():
+            return FastJSONResponse(adapter.dump_python(adapter.validate_python(data), mode="json")).body
+
+        assert json.loads(before()) == json.loads(after()), label
+        old, new = per_call_us(before), per_call_us(after)
+        print(f"{label:>20}: {old:6.0f} us -> {new:5.0f} us ({old / new:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
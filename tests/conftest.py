@@ -0,0 +1,77 @@
+"""
+Fixtures running the app against a scratch SQLite file
+"""
+import contextlib
+import os
+import sqlite3
+import tempfile
+
+import pytest
+
+DATABASE = os.path.join(tempfile.mkdtemp(prefix="chat-tests-"), "test.db")
+# Settings are read when api is first imported
+os.environ.update(
+    DATABASE_URL=f"sqlite:///{DATABASE}",
+    BROKER_URL="",
+    BCRYPT_ROUNDS="4",
+    BCRYPT_TARGET_MS="0",
+    RATE_LIMIT_REQUESTS="1000000",
+)
+
+from fastapi.testclient import TestClient  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+
+from api.app import app  # noqa: E402
+from api.db.database import async_engine  # noqa: E402
+
+PLANNED = ("SELECT", "UPDATE", "DELETE", "WITH")
+
+
+@pytest.fixture(scope="session")
+def client():
+    with TestClient(app) as client:
+        yield client
+
+
+@contextlib.contextmanager
+def recording():
+    """Collect the (statement, parameters) the async engine runs inside the block"""
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(PLANNED):
+            statements.append((statement, parameters[0] if executemany else parameters))
+
+    event.listen(async_engine.sync_engine, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        event.remove(async_engine.sync_engine, "before_cursor_execute", record)
+
+
+def query_plan(statement: str, parameters) -> list:
+    with contextlib.closing(sqlite3.connect(DATABASE)) as db:
+        return [row[3] for row in db.execute("EXPLAIN QUERY PLAN " + statement, parameters)]
+
+
+def plan_problems(plan: list) -> list:
+    """Full scans of a table and sorts through a temporary b-tree"""
+    # Subqueries SQLite runs as co-routines or materializes are read back with SCAN
+    subqueries = {line.split()[1] for line in plan if line.startswith(("CO-ROUTINE ", "MATERIALIZE "))}
+    return [
+        line for line in plan
+        if "TEMP B-TREE" in line
+        or (line.startswith("SCAN ") and line.split()[1] not in subqueries and not line.startswith("SCAN CONSTANT ROW"))
+    ]
+
+
+def assert_indexed(statements: list, allow=()):
+    """Every statement searches an index; ``allow`` lists plan lines accepted anyway"""
+    assert statements, "no queries were recorded"
+    failures = []
+    for statement, parameters in statements:
+        plan = query_plan(statement, parameters)
+        problems = [line for line in plan_problems(plan) if line not in allow]
+        if problems:
+            failures.append(f"{' '.join(statement.split())}\n    {problems}")
+    assert not failures, "\n".join(failures)
@@ -0,0 +1,37 @@
+"""
+A socket that stalls or fails a send is closed, so its client reconnects
+"""
+import asyncio
+
+from api.config.settings import settings
+from api.utils.websocket_manager import fan_out
+
+
+class Socket:
+    def __init__(self, stall: bool = False):
+        self.stall = stall
+        self.received = []
+        self.closed = None
+
+    async def send_text(self, payload: str):
+        if self.stall:
+            await asyncio.sleep(60)
+        self.received.append(payload)
+
+    async def close(self, code: int = 1000):
+        self.closed = code
+
+
+def test_stalled_socket_is_closed(monkeypatch):
+    monkeypatch.setattr(settings, "ws_send_timeout", 0.05)
+    healthy, stalled = Socket(), Socket(stall=True)
+
+    async def run():
+        failed, stats = await fan_out([healthy, stalled], {"type": "ping"})
+        await asyncio.sleep(0)
+        return failed, stats
+
+    failed, stats = asyncio.run(run())
+    assert failed == [stalled] and stats["failed"] == 1
+    assert healthy.received and healthy.closed is None
+    assert stalled.closed == 1013
@@ -0,0 +1,133 @@
+"""
+First pages served from the history buffer match the database, and the
+buffers are dropped when broker frames are lost
+"""
+import asyncio
+
+import pytest
+from fastapi.encoders import jsonable_encoder
+
+from api.db.database import AsyncSessionLocal
+from api.routers.Message import load_messages
+from api.utils import broker as broker_module
+from api.utils.broker import DROPPED, SocketBroker, encode_frame
+from api.utils.message_history import message_history
+from api.utils.websocket_manager import connection_manager
+
+
+def ok(response, code=200):
+    assert response.status_code == code, response.text
+    return response.json()
+
+
+@pytest.fixture(scope="module")
+def members(client):
+    headers = {}
+    for name in ("erin", "frank"):
+        data = ok(client.post("/auth/register", json={
+            "email": f"{name}@example.com", "password": "Passw0rd!", "username": name, "nickname": name.title(),
+        }), 201)
+        headers[name] = {"Authorization": f"Bearer {data['access_token']}"}
+    return headers
+
+
+@pytest.fixture
+def group(client, members, monkeypatch):
+    """A fresh group of two, with buffers of ten messages"""
+    monkeypatch.setattr(message_history, "size", 10)
+    message_history.clear()
+    group = ok(client.post("/group/create", json={"name": "History"}, headers=members["erin"]))["id"]
+    for headers in members.values():
+        ok(client.post(f"/group/join?group_id={group}", headers=headers))
+    yield group
+    message_history.clear()
+
+
+def assert_same(client, group, *limits):
+    async def from_db(limit):
+        async with AsyncSessionLocal() as db:
+            messages, next_cursor = await load_messages(db, group, limit=limit)
+        return {"messages": messages, "next_cursor": next_cursor}
+
+    for limit in limits:
+        cached = ok(client.get(f"/{group}/message/fetch?limit={limit}"))
+        assert cached == jsonable_encoder(client.portal.call(from_db, limit)), limit
+
+
+def test_cached_pages_match_database(client, members, group):
+    assert_same(client, group, 5)
+
+    sent = []
+    for i in range(16):
+        author = "frank" if i % 2 else "erin"
+        reply = f"?reply_to_id={sent[-1][0]}" if i > 4 and i % 3 == 0 else ""
+        message = ok(client.post(f"/{group}/message{reply}", json={"content": f"m{i}"}, headers=members[author]))
+        sent.append((message["data"]["id"], author))
+        if i == 3:
+            assert_same(client, group, 1, 3, 4, 5, 10)
+    hits = message_history.hits
+    assert_same(client, group, 1, 5, 9)
+    assert message_history.hits > hits
+
+    for (id, author), content in zip(sent[-4:-2], ("edited", "edited again")):
+        ok(client.put(f"/message/{id}/edit", json={"content": content}, headers=members[author]))
+    assert_same(client, group, 5, 9)
+    id, author = sent[-1]
+    ok(client.delete(f"/message/{id}", headers=members[author]))
+    assert_same(client, group, 5, 9, 10)
+
+    ok(client.post("/user/test/update/", json={"nickname": "Franky"}, headers=members["frank"]))
+    assert group not in message_history.groups
+    assert_same(client, group, 5, 9, 10)
+
+
+def test_dropped_frames_clear_buffers(client, members, group):
+    ok(client.post(f"/{group}/message", json={"content": "hello"}, headers=members["erin"]))
+    ok(client.get(f"/{group}/message/fetch?limit=5"))
+    assert group in message_history.groups
+
+    client.portal.call(connection_manager.deliver, "peer", [DROPPED], "{}")
+    assert not message_history.groups
+
+
+class Writer:
+    def __init__(self):
+        self.frames = []
+        self.transport = self
+
+    def get_write_buffer_size(self):
+        return 0
+
+    def is_closing(self):
+        return False
+
+    def write(self, frame: bytes):
+        self.frames.append(frame)
+
+
+def test_socket_broker_reports_lost_frames(monkeypatch):
+    monkeypatch.setattr(broker_module, "MAX_PENDING", 2)
+
+    async def run():
+        delivered = []
+
+        async def deliver(origin, channels, payload):
+            delivered.append(channels[0])
+            await asyncio.sleep(0.01)
+            return {}
+
+        broker = SocketBroker(deliver, "tcp://127.0.0.1:1")
+        # Published while disconnected: peers are told before the next frame
+        broker._send(encode_frame(broker.origin, ["group:1"], "{}"))
+        broker.writer = Writer()
+        broker._send(encode_frame(broker.origin, ["group:2"], "{}"))
+        broker._send(encode_frame(broker.origin, ["group:3"], "{}"))
+        assert [frame.split()[1] for frame in broker.writer.frames] == [DROPPED.encode(), b"group:2", b"group:3"]
+
+        # Dropped on the way in: this worker is told once
+        for key in range(5):
+            broker._dispatch(encode_frame("peer", [f"group:{key}"], "{}"))
+        await asyncio.gather(*broker._pending)
+        assert delivered == ["group:0", "group:1", DROPPED]
+
+    asyncio.run(run())
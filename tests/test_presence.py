@@ -0,0 +1,72 @@
+"""
+Presence follows a user's first and last socket, whatever kind they are
+"""
+import asyncio
+import contextlib
+import sqlite3
+
+from conftest import DATABASE
+from api.utils.websocket_manager import ConnectionManager
+
+
+class FakeSocket:
+    async def send_text(self, payload: str):
+        pass
+
+
+def test_first_and_last_socket_of_any_kind():
+    manager = ConnectionManager()
+    group, user = FakeSocket(), FakeSocket()
+
+    assert asyncio.run(manager.connect_to_group(group, 1, 7))
+    assert manager.presence_changes == {7: True}
+    manager.presence_changes.clear()
+    assert not asyncio.run(manager.connect_user(user, 7))
+    assert not asyncio.run(manager.disconnect_user(user, 7))
+    assert manager.presence_changes == {}
+    assert manager.is_user_online(7)
+
+    assert manager.disconnect_from_group(group, 1, 7)
+    assert manager.presence_changes == {7: False}
+    assert not manager.is_user_online(7)
+    assert 7 not in manager.user_connections
+
+
+def test_socket_joined_to_rooms_goes_away_once_closed():
+    manager = ConnectionManager()
+    user = FakeSocket()
+
+    asyncio.run(manager.connect_user(user, 7))
+    asyncio.run(manager.connect_to_group(user, 1, 7))
+    asyncio.run(manager.connect_to_dm(user, "7_8", 7))
+    assert not manager.disconnect_from_group(user, 1, 7)
+    assert asyncio.run(manager.disconnect_user(user, 7))
+    assert manager.presence_changes == {7: False}
+    assert not manager.is_user_online(7)
+
+
+def test_last_socket_persists_offline(client):
+    from api.utils.presence import presence_writer
+
+    data = client.post("/auth/register", json={
+        "email": "dana@example.com", "password": "Passw0rd!", "username": "dana", "nickname": "Dana",
+    }).json()
+    user_id, token = data["user"]["id"], data["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    group = client.post("/group/create", json={"name": "Presence"}, headers=headers).json()["id"]
+    client.post(f"/group/join?group_id={group}", headers=headers)
+
+    def is_online():
+        client.portal.call(presence_writer.flush)
+        with contextlib.closing(sqlite3.connect(DATABASE)) as db:
+            return db.execute("SELECT is_online, status FROM users WHERE id = ?", (user_id,)).fetchone() == (1, 1)
+
+    with client.websocket_connect(f"/group/{group}") as group_socket:
+        group_socket.send_text(token)
+        with client.websocket_connect(f"/ws/{user_id}") as websocket:
+            websocket.send_json({"token": token})
+            websocket.receive_json()
+        # The group socket still keeps the user online
+        assert is_online()
+        group_socket.send_json({"type": "typing_stop"})
+    assert not is_online()
@@ -0,0 +1,153 @@
+"""
+Every query behind the routers reads through an index.
+
+Each test drives endpoints through the app, records the SQL they run and
+checks its EXPLAIN QUERY PLAN for full table scans and temp b-tree sorts.
+"""
+import pytest
+
+from conftest import assert_indexed, recording
+from api.utils.message_history import message_history
+from api.utils.presence import presence_writer
+from api.utils.read_receipts import read_receipts
+from api.utils.read_state import unread_counter
+
+
+def ok(response, code=200):
+    assert response.status_code == code, response.text
+    return response.json()
+
+
+@pytest.fixture(scope="module")
+def chat(client):
+    """Three users, a group of two with some history, DMs both ways and a friendship"""
+    users, headers = {}, {}
+    for name in ("alice", "bobby", "carol"):
+        data = ok(client.post("/auth/register", json={
+            "email": f"{name}@example.com", "password": "Passw0rd!", "username": name, "nickname": name.title(),
+        }), 201)
+        users[name] = data["user"]["id"]
+        headers[name] = {"Authorization": f"Bearer {data['access_token']}"}
+
+    group = ok(client.post("/group/create", json={"name": "General", "description": "x"}, headers=headers["alice"]))["id"]
+    ok(client.post("/group/create", json={"name": "Random"}, headers=headers["carol"]))
+    for name in ("alice", "bobby"):
+        ok(client.post(f"/group/join?group_id={group}", headers=headers[name]))
+    messages = [
+        ok(client.post(f"/{group}/message", json={"content": f"hi {i}"}, headers=headers["alice" if i % 2 else "bobby"]))["data"]["id"]
+        for i in range(20)
+    ]
+    dms = [
+        ok(client.post(f"/dm/{users['bobby' if i % 2 else 'alice']}/send", json={"content": f"dm {i}"},
+                       headers=headers["alice" if i % 2 else "bobby"]))["data"]["id"]
+        for i in range(10)
+    ]
+    request = ok(client.post(f"/friends/request/{users['bobby']}", headers=headers["alice"]))
+    ok(client.post(f"/friends/accept/{request['request_id']}", headers=headers["bobby"]))
+    return {"users": users, "headers": headers, "group": group, "messages": messages, "dms": dms}
+
+
+def test_auth(client, chat):
+    with recording() as statements:
+        ok(client.post("/auth/login", data={"username": "alice", "password": "Passw0rd!"}))
+        ok(client.get("/user/u/bobby", headers=chat["headers"]["alice"]))
+        ok(client.get(f"/user/id/{chat['users']['bobby']}", headers=chat["headers"]["alice"]))
+    assert_indexed(statements)
+
+
+def test_group_history(client, chat):
+    group, messages, alice = chat["group"], chat["messages"], chat["headers"]["alice"]
+    message_history.clear()
+    with recording() as statements:
+        ok(client.get(f"/{group}/message/fetch"))
+        ok(client.get(f"/{group}/message/fetch?before={messages[10]}&limit=5"))
+        ok(client.get(f"/{group}/message/fetch?after={messages[5]}&limit=5"))
+        client.get(f"/{group}/message/export", headers=alice).read()
+    assert_indexed(statements)
+
+
+def test_group_messages(client, chat):
+    group, messages, headers = chat["group"], chat["messages"], chat["headers"]
+    with recording() as statements:
+        ok(client.post(f"/{group}/message?reply_to_id={messages[0]}", json={"content": "reply"}, headers=headers["bobby"]))
+        ok(client.post(f"/{group}/message/batch", json={"messages": [
+            {"content": "one"}, {"content": "two", "reply_to_id": messages[1]},
+        ]}, headers=headers["alice"]))
+        ok(client.put(f"/message/{messages[-1]}/edit", json={"content": "edited"}, headers=headers["alice"]))
+        ok(client.delete(f"/message/{messages[-2]}", headers=headers["bobby"]))
+        client.portal.call(unread_counter.flush)
+        ok(client.post(f"/group/read/{group}?message_id={messages[4]}", headers=headers["bobby"]))
+        ok(client.post(f"/group/read/{group}", headers=headers["alice"]))
+    assert_indexed(statements)
+
+
+def test_group_membership(client, chat):
+    carol = chat["headers"]["carol"]
+    with recording() as statements:
+        first = ok(client.get("/group/list?limit=1", headers=carol))
+        ok(client.get(f"/group/list?after={first['next_cursor']}", headers=carol))
+        ok(client.post(f"/group/join?group_id={chat['group']}", headers=carol))
+        ok(client.post(f"/group/leave/{chat['group']}", headers=carol))
+    # The first page of the directory walks the primary key and stops at the limit
+    assert_indexed(statements, allow=("SCAN groups USING INDEX sqlite_autoindex_groups_1",))
+
+
+def test_group_chats(client, chat):
+    with recording() as statements:
+        ok(client.get("/user/alice/chats"))
+    # Ordering by latest message sorts only the user's own memberships
+    assert_indexed(statements, allow=("USE TEMP B-TREE FOR ORDER BY",))
+
+
+def test_direct_message_history(client, chat):
+    users, dms, alice = chat["users"], chat["dms"], chat["headers"]["alice"]
+    with recording() as statements:
+        ok(client.get(f"/dm/{users['bobby']}/messages", headers=alice))
+        ok(client.get(f"/dm/{users['bobby']}/messages?before={dms[6]}&limit=3", headers=alice))
+        ok(client.get(f"/dm/{users['bobby']}/messages?after={dms[2]}&limit=3", headers=alice))
+        client.get(f"/dm/{users['bobby']}/export", headers=alice).read()
+        ok(client.get("/dm/conversations", headers=alice))
+    assert_indexed(statements)
+
+
+def test_direct_messages(client, chat):
+    users, dms, headers = chat["users"], chat["dms"], chat["headers"]
+    with recording() as statements:
+        ok(client.post(f"/dm/{users['bobby']}/send?reply_to_id={dms[0]}", json={"content": "re"}, headers=headers["alice"]))
+        ok(client.put(f"/dm/message/{dms[1]}/edit", json={"content": "edited"}, headers=headers["alice"]))
+        sent = ok(client.post(f"/dm/{users['alice']}/send", json={"content": "newest"}, headers=headers["bobby"]))
+        # Deleting the newest message looks up the one before it
+        ok(client.delete(f"/dm/message/{sent['data']['id']}", headers=headers["bobby"]))
+        ok(client.post(f"/dm/{users['bobby']}/read", headers=headers["alice"]))
+        ok(client.post(f"/dm/{users['alice']}/send", json={"content": "hello"}, headers=headers["carol"]))
+        ok(client.delete(f"/dm/conversation/{users['alice']}", headers=headers["carol"]))
+    assert_indexed(statements)
+
+
+def test_friends(client, chat):
+    users, headers = chat["users"], chat["headers"]
+    with recording() as statements:
+        request = ok(client.post(f"/friends/request/{users['carol']}", headers=headers["bobby"]))
+        ok(client.get("/friends/requests", headers=headers["carol"]))
+        ok(client.post(f"/friends/reject/{request['request_id']}", headers=headers["carol"]))
+        ok(client.get("/friends/list", headers=headers["alice"]))
+        ok(client.delete(f"/friends/remove/{users['bobby']}", headers=headers["alice"]))
+        ok(client.post(f"/friends/block/{users['carol']}", headers=headers["alice"]))
+        ok(client.post(f"/friends/unblock/{users['carol']}", headers=headers["alice"]))
+    assert_indexed(statements)
+
+
+def test_background_writes(client, chat):
+    users, group, dms = chat["users"], chat["group"], chat["dms"]
+    with recording() as statements:
+        with client.websocket_connect(f"/ws/{users['alice']}") as websocket:
+            token = chat["headers"]["alice"]["Authorization"].split()[1]
+            websocket.send_json({"token": token})
+            websocket.receive_json()
+        presence_writer.record_online(users["bobby"])
+        client.portal.call(presence_writer.flush)
+        read_receipts.record("group", group, users["bobby"], chat["messages"][8])
+        read_receipts.record("dm", f"{min(users['alice'], users['bobby'])}_{max(users['alice'], users['bobby'])}",
+                             users["bobby"], dms[-2])
+        client.portal.call(read_receipts.flush)
+    assert_indexed(statements)
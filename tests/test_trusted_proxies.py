@@ -0,0 +1,28 @@
+"""
+Trusted proxies are read from the environment as a comma-separated list
+"""
+import pytest
+
+from api.config.settings import Settings
+from api.middleware.security import SecurityMiddleware
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("10.0.0.1", ["10.0.0.1"]),
+    ("10.0.0.0/8,127.0.0.1", ["10.0.0.0/8", "127.0.0.1"]),
+    (" 10.0.0.0/8 , ::1 ,", ["10.0.0.0/8", "::1"]),
+    ("", []),
+])
+def test_env_form(monkeypatch, value, expected):
+    monkeypatch.setenv("TRUSTED_PROXIES", value)
+    assert Settings().trusted_proxy_list == expected
+
+
+def test_forwarded_for_only_believed_from_trusted_proxies(monkeypatch):
+    monkeypatch.setenv("TRUSTED_PROXIES", "10.0.0.0/8,127.0.0.1")
+    middleware = SecurityMiddleware(None, trusted_proxies=Settings().trusted_proxy_list)
+    headers = {b"x-forwarded-for": b"203.0.113.9, 198.51.100.7, 10.1.2.3"}
+
+    assert middleware.get_client_ip({"client": ("10.9.9.9", 443)}, headers) == "198.51.100.7"
+    assert middleware.get_client_ip({"client": ("127.0.0.1", 443)}, {b"x-real-ip": b"198.51.100.7"}) == "198.51.100.7"
+    assert middleware.get_client_ip({"client": ("192.0.2.1", 443)}, headers) == "192.0.2.1"
@@ -0,0 +1,49 @@
+"""
+Chat sockets give their database connection back once they are set up
+"""
+import contextlib
+import time
+
+from api.db.database import async_engine
+
+
+def ok(response, code=200):
+    assert response.status_code == code, response.text
+    return response.json()
+
+
+def checked_out(expected: int) -> bool:
+    # The handlers run on the client's event loop thread
+    deadline = time.monotonic() + 2
+    while async_engine.pool.checkedout() != expected and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return async_engine.pool.checkedout() == expected
+
+
+def test_open_sockets_hold_no_connections(client):
+    users, tokens = [], []
+    for name in ("gina", "hank"):
+        data = ok(client.post("/auth/register", json={
+            "email": f"{name}@example.com", "password": "Passw0rd!", "username": name, "nickname": name.title(),
+        }), 201)
+        users.append(data["user"]["id"])
+        tokens.append(data["access_token"])
+    headers = {"Authorization": f"Bearer {tokens[0]}"}
+    group = ok(client.post("/group/create", json={"name": "Sockets"}, headers=headers))["id"]
+    ok(client.post(f"/group/join?group_id={group}", headers=headers))
+    assert checked_out(0)
+
+    with contextlib.ExitStack() as sockets:
+        for _ in range(3):
+            websocket = sockets.enter_context(client.websocket_connect(f"/group/{group}"))
+            websocket.send_text(tokens[0])
+            assert websocket.receive_json()["type"] == "user_joined"
+        websocket = sockets.enter_context(client.websocket_connect(f"/dm/{users[1]}"))
+        websocket.send_text(tokens[0])
+        websocket = sockets.enter_context(client.websocket_connect(f"/ws/{users[0]}"))
+        websocket.send_json({"token": tokens[0]})
+        websocket.receive_json()
+        # Both wait for their token with the session already closed
+        sockets.enter_context(client.websocket_connect(f"/chat/{group}"))
+        sockets.enter_context(client.websocket_connect(f"/dm/chat/{users[1]}"))
+        assert checked_out(0)